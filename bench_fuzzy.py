@@ -0,0 +1,138 @@
+"""Микробенчмарк нечеткого поиска: индекс FuzzyIndex против полного process.extractOne.
+Те же запросы прогоняются через весь find_best_match (с поиском по звучанию) и сравниваются
+со старой реализацией: найденный ею город должен остаться прежним.
+
+Вторая часть - ввод латиницей: города каталога в разных системах транслитерации
+ищутся через find_best_match, печатается доля найденных по звучанию (без fuzz.ratio).
+
+Запуск: python bench_fuzzy.py [количество_запросов]
+"""
+import random
+import sys
+import time
+
+from thefuzz import process, fuzz
+
+import main
+
+ALPHABET = "абвгдеёжзийклмнопрстуфхцчшщъыьэюя"
+
+
+def make_typo(city: str, rng: random.Random) -> str:
+    chars = list(city)
+    for _ in range(rng.randint(1, 2)):
+        op = rng.choice(("del", "ins", "sub", "swap"))
+        pos = rng.randrange(len(chars)) if chars else 0
+        if op == "del" and len(chars) > 1:
+            del chars[pos]
+        elif op == "ins":
+            chars.insert(pos, rng.choice(ALPHABET))
+        elif op == "sub" and chars:
+            chars[pos] = rng.choice(ALPHABET)
+        elif op == "swap" and pos + 1 < len(chars):
+            chars[pos], chars[pos + 1] = chars[pos + 1], chars[pos]
+    return "".join(chars)
+
+
+# Расхождения с транслитерацией main._CYR_TO_LAT, которые встречаются у игроков
+ROMANIZATION_VARIANTS = {
+    "ё": ("yo", "e", "jo"), "й": ("y", "i", "j"), "х": ("kh", "h"), "ц": ("ts", "tz", "c"), "ч": ("ch", "tch"),
+    "щ": ("shch", "sch"), "ы": ("y", "i"), "ю": ("yu", "ju", "iu"), "я": ("ya", "ja", "ia"), "ж": ("zh", "j"),
+    "ь": ("", "'"), "е": ("e", "e", "ye"),
+}
+
+
+def romanize(norm: str, rng: random.Random) -> str:
+    return "".join(rng.choice(ROMANIZATION_VARIANTS.get(ch) or (main._CYR_TO_LAT[ch],)) for ch in norm)
+
+
+# Латинские слова, которые не названия городов: бот не должен принимать их за ход
+LATIN_NON_CITIES = ("hello", "test", "qwerty", "new york", "paris", "privet", "gorod", "bot", "help", "asdf",
+                    "london is the capital", "ok", "thanks", "moscow city", "abcdef")
+
+
+def latin_bench(count: int):
+    rng = random.Random(7)
+    originals = [rng.choice(main.CITIES_KEYS) for _ in range(count)]
+    queries = [romanize(norm, rng) for norm in originals]
+
+    before = dict(main.METRICS._counters)
+    main._fuzzy_match.cache_clear()
+    start = time.perf_counter()
+    results = [main.find_best_match(q) for q in queries]
+    elapsed = time.perf_counter() - start
+
+    def counted(result: str) -> float:
+        key = ("cities_match_total", (("result", result),))
+        return main.METRICS._counters.get(key, 0) - before.get(key, 0)
+
+    correct = sum(1 for norm, found in zip(originals, results) if found and found[0] == norm)
+    print(f"\nЛатиница, запросов: {count}, {elapsed / count * 1000:.3f} мс/запрос")
+    print(f"По звучанию: {counted('phonetic'):.0f}, нечетко: {counted('fuzzy'):.0f}, не найдено: {counted('miss'):.0f}; "
+          f"найден исходный город: {correct / count:.0%}")
+    accepted = [(word, found[1]) for word in LATIN_NON_CITIES if (found := main.find_best_match(word))]
+    print(f"Латинские слова не из каталога: принято {len(accepted)} из {len(LATIN_NON_CITIES)} {accepted or ''}")
+
+
+def old_find_best_match(user_norm: str, threshold: int = 72):
+    result = process.extractOne(user_norm, main.CITIES_KEYS, scorer=fuzz.ratio)
+    if result:
+        best_match, score = result
+        if score >= threshold:
+            return best_match
+    return None
+
+
+def main_bench(count: int):
+    rng = random.Random(42)
+    queries = [make_typo(rng.choice(main.CITIES_KEYS), rng) for _ in range(count)]
+    queries = [q for q in queries if q not in main.CITIES_MAP]
+
+    start = time.perf_counter()
+    expected = [old_find_best_match(q) for q in queries]
+    old_time = time.perf_counter() - start
+
+    main._fuzzy_match.cache_clear()
+    start = time.perf_counter()
+    actual = [main._fuzzy_match(q, 72, None) for q in queries]
+    new_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for q in queries:
+        main._fuzzy_match(q, 72, None)
+    cached_time = time.perf_counter() - start
+
+    main._fuzzy_match.cache_clear()
+    start = time.perf_counter()
+    for q in queries:
+        main._fuzzy_match(q, 72, q[0] if q else None)
+    letter_time = time.perf_counter() - start
+
+    mismatches = [(q, e, a) for q, e, a in zip(queries, expected, actual) if e != a]
+
+    # Весь путь find_best_match: расхождение - если старая реализация нашла город, а новая другой
+    # (или ничего); там, где старая не нашла ничего, новая может найти город по звучанию
+    full = [(main.find_best_match(q) or (None,))[0] for q in queries]
+    full_mismatches = [(q, e, a) for q, e, a in zip(queries, expected, full) if e is not None and e != a]
+    rescued = sum(1 for e, a in zip(expected, full) if e is None and a is not None)
+
+    n = len(queries)
+    print(f"Запросов: {n}")
+    print(f"extractOne (полный перебор): {old_time / n * 1000:.3f} мс/запрос")
+    print(f"FuzzyIndex:                  {new_time / n * 1000:.3f} мс/запрос (x{old_time / new_time:.1f})")
+    print(f"FuzzyIndex + буква:          {letter_time / n * 1000:.3f} мс/запрос")
+    print(f"FuzzyIndex из LRU-кэша:      {cached_time / n * 1000:.4f} мс/запрос")
+    print(f"Расхождений с extractOne: {len(mismatches)}")
+    for q, e, a in mismatches[:10]:
+        print(f"  {q!r}: было {e!r}, стало {a!r}")
+    print(f"find_best_match: расхождений со старой реализацией {len(full_mismatches)}, "
+          f"найдено по звучанию сверх нее {rescued}")
+    for q, e, a in full_mismatches[:10]:
+        print(f"  {q!r}: было {e!r}, стало {a!r}")
+    return not mismatches and not full_mismatches
+
+
+if __name__ == "__main__":
+    ok = main_bench(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
+    latin_bench(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,316 @@
+"""Офлайн-нагрузка на бота без Telegram: синтетические апдейты через dp.feed_update.
+
+Много пользователей одновременно играют полные партии: называют города (иногда
+с опечатками или не на ту букву), жмут подсказку, просят факты у ИИ и
+соглашаются продолжить на предпоследнюю букву. Bot работает через заглушку
+сессии, Gemini - через заглушку модели с настраиваемой задержкой. С --think
+игроки думают перед ходом, как живые, и предзагрузка справок (--prefetch) успевает.
+В конце печатается пропускная способность и p50/p95/p99 по обработчикам.
+
+Время до первого текста справки (facts_first_edit) сравнивается запуском
+с --no-streaming, когда справка приходит от ИИ целиком.
+
+Запуск: python bench_load.py --users 200 --moves 30
+"""
+import argparse
+import asyncio
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.methods import EditMessageText, TelegramMethod
+from aiogram.types import CallbackQuery, Chat, InlineKeyboardMarkup, Message, Update, User
+
+import main
+from bench_fuzzy import make_typo
+
+BOT_TOKEN = "123456:TEST-TOKEN-FOR-OFFLINE-BENCHMARK"
+BOT_USER = User(id=123456, is_bot=True, first_name="CitiesBot")
+
+# Имя обработчика -> список задержек в секундах
+TIMINGS: Dict[str, List[float]] = {}
+
+
+def record(name: str, seconds: float):
+    TIMINGS.setdefault(name, []).append(seconds)
+
+
+class StubSession(BaseSession):
+    """Вместо HTTP к Bot API запоминает последнее сообщение бота в каждом чате"""
+
+    def __init__(self):
+        super().__init__()
+        self.last_message: Dict[int, Message] = {}
+        self.message_id = 0
+        self.requests = 0
+        # (chat_id, message_id) -> когда игрок нажал кнопку фактов (до первой правки сообщения)
+        self.facts_clicked: Dict[Tuple[int, int], float] = {}
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None) -> Any:
+        self.requests += 1
+        edit = isinstance(method, EditMessageText)
+        if edit and (method.chat_id, method.message_id) in self.facts_clicked:
+            record("facts_first_edit", time.perf_counter() - self.facts_clicked.pop((method.chat_id, method.message_id)))
+        if method.__returning__ is not Message and not edit:
+            return True
+
+        self.message_id += 1
+        chat_id = method.chat_id
+        text = re.sub(r"<[^>]+>", "", method.text)
+        markup = getattr(method, "reply_markup", None)
+        message = Message(
+            message_id=getattr(method, "message_id", None) or self.message_id,
+            date=datetime.now(),
+            chat=Chat(id=chat_id, type="private"),
+            from_user=BOT_USER,
+            text=text,
+            reply_markup=markup if isinstance(markup, InlineKeyboardMarkup) else None,
+        )
+        # Справка дописывается в старое сообщение, пока игрок уже ходит дальше
+        last = self.last_message.get(chat_id)
+        if not edit or last is None or last.message_id == message.message_id:
+            self.last_message[chat_id] = message
+        return message
+
+    async def stream_content(self, *args, **kwargs):
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class StubResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class StubStream:
+    """Потоковый ответ заглушки: первый кусок через пятую часть задержки, остальные равномерно"""
+
+    def __init__(self, model: "StubModel", chunks: int = 8):
+        self.model = model
+        self.chunks = chunks
+
+    async def __aiter__(self):
+        latency = self.model.latency * random.uniform(0.5, 1.5)
+        await asyncio.sleep(latency / 5)
+        for i in range(self.chunks):
+            if i:
+                await asyncio.sleep(latency * 4 / 5 / (self.chunks - 1))
+            if random.random() < self.model.error_rate / self.chunks:
+                raise RuntimeError("stub Gemini error")
+            yield StubResponse(f"<b>🏳️ Справка</b>-заглушка {i}. " * 3)
+
+
+class StubModel:
+    """Заглушка Gemini: отвечает через latency секунд, иногда с ошибкой"""
+
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = 0
+
+    async def generate_content_async(self, prompt: str, stream: bool = False, **kwargs):
+        self.calls += 1
+        if stream:
+            return StubStream(self)
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if random.random() < self.error_rate:
+            raise RuntimeError("stub Gemini error")
+        return StubResponse("🏳️ Справка-заглушка. " * 20)
+
+
+class TimingMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            handler_object = data.get("handler")
+            name = handler_object.callback.__name__ if handler_object else "unhandled"
+            record(name, time.perf_counter() - start)
+
+
+def timed(name: str, func):
+    if asyncio.iscoroutinefunction(func):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+    else:
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+    return wrapper
+
+
+class SyntheticUser:
+
+    def __init__(self, user_id: int, bot: Bot, session: StubSession, args, counter):
+        self.user = User(id=user_id, is_bot=False, first_name=f"Игрок {user_id}")
+        self.chat = Chat(id=user_id, type="private")
+        self.key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
+        self.bot = bot
+        self.session = session
+        self.args = args
+        self.counter = counter
+        self.rng = random.Random(user_id)
+
+    def _update_id(self) -> int:
+        self.counter[0] += 1
+        return self.counter[0]
+
+    async def send_text(self, text: str):
+        message = Message(message_id=self._update_id(), date=datetime.now(), chat=self.chat,
+                          from_user=self.user, text=text)
+        await main.dp.feed_update(self.bot, Update(update_id=self._update_id(), message=message))
+
+    async def press(self, data: str):
+        bot_message = self.session.last_message.get(self.chat.id)
+        if bot_message is None:
+            return
+        if data == "get_facts":
+            self.session.facts_clicked.setdefault((self.chat.id, bot_message.message_id), time.perf_counter())
+        callback = CallbackQuery(id=str(self._update_id()), from_user=self.user, chat_instance=str(self.chat.id),
+                                 message=bot_message, data=data)
+        await main.dp.feed_update(self.bot, Update(update_id=self._update_id(), callback_query=callback))
+
+    def _last_buttons(self) -> List[str]:
+        bot_message = self.session.last_message.get(self.chat.id)
+        markup = bot_message.reply_markup if bot_message else None
+        if not markup or not hasattr(markup, "inline_keyboard"):
+            return []
+        return [button.callback_data for row in markup.inline_keyboard for button in row if button.callback_data]
+
+    async def play(self):
+        await self.send_text("/start")
+        for _ in range(self.args.moves):
+            await asyncio.sleep(self.args.think * self.rng.uniform(0.5, 1.5))
+            buttons = self._last_buttons()
+            cont = next((b for b in buttons if b.startswith("cont_")), None)
+            if cont:
+                await self.press(cont)
+                continue
+            if "get_facts" in buttons and self.rng.random() < self.args.facts:
+                await self.press("get_facts")
+
+            if self.rng.random() < self.args.hint:
+                await self.send_text("💡 Подсказка")
+
+            data = await main.dp.storage.get_data(self.key)
+            if not data:
+                break
+            letter = data.get("last_letter")
+            if letter and self.rng.random() < self.args.wrong_letter:
+                letter = None
+            norm = main.pick_city(data, letter) if letter else self.rng.choice(main.CITIES_KEYS)
+            if norm is None and data.get("penult_letter"):
+                norm = main.pick_city(data, data["penult_letter"], prefer_top=False)
+            if norm is None:
+                break
+
+            city = main.CITIES_MAP[norm]
+            if self.rng.random() < self.args.typo:
+                city = make_typo(norm, self.rng)
+            await self.send_text(city)
+
+        await self.send_text("🔄 Закончить текущую игру")
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="cities-bench-")
+    try:
+        if args.storage == "paged":
+            storage = main.PagedJournalStorage(os.path.join(workdir, "bot_state.pkl"))
+        elif args.storage == "journal":
+            storage = main.JournalFileStorage(os.path.join(workdir, "bot_state.pkl"))
+        elif args.storage == "pickle":
+            storage = main.PickleFileStorage(os.path.join(workdir, "bot_state.pkl"))
+        elif args.storage == "sqlite":
+            storage = main.SqliteStorage(os.path.join(workdir, "cities.db"))
+        else:
+            from aiogram.fsm.storage.memory import MemoryStorage
+            storage = MemoryStorage()
+        main.dp.fsm.storage = storage
+        main.HIGH_SCORES = main.HighScores(os.path.join(workdir, "highscores.json"))
+        main.CITY_FACTS = main.CityFactsCache(os.path.join(workdir, "city_facts.json"))
+        main.model = StubModel(args.gemini_latency, args.gemini_errors)
+        main.FACTS_STREAMING = args.streaming
+        main.FACTS_PREFETCH_RATE = args.prefetch
+        main.FACTS_PREFETCH_BUDGET = args.prefetch_budget
+        main.FACTS_PREFETCH = main.make_prefetcher()
+        main.find_best_match = timed("find_best_match", main.find_best_match)
+        main.make_bot_move = timed("make_bot_move", main.make_bot_move)
+        main.dp.message.middleware(TimingMiddleware())
+        main.dp.callback_query.middleware(TimingMiddleware())
+
+        session = StubSession()
+        bot = Bot(token=BOT_TOKEN, session=session)
+        counter = [0]
+        users = [SyntheticUser(100000 + i, bot, session, args, counter) for i in range(args.users)]
+
+        start = time.perf_counter()
+        await asyncio.gather(*(user.play() for user in users))
+        elapsed = time.perf_counter() - start
+        # Дожидаемся справок, которые еще дописываются в фоне
+        while main._facts_edits:
+            await asyncio.gather(*main._facts_edits.values(), return_exceptions=True)
+        await storage.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    updates = sum(len(v) for k, v in TIMINGS.items() if k not in ("find_best_match", "make_bot_move", "facts_first_edit"))
+    print(f"Пользователей: {args.users}, апдейтов: {updates}, запросов к Bot API: {session.requests}, "
+          f"вызовов Gemini: {main.model.calls}")
+    print(f"Время: {elapsed:.2f} с, пропускная способность: {updates / elapsed:.0f} апдейтов/с\n")
+    print(f"{'обработчик':<28}{'вызовов':>9}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for name, values in sorted(TIMINGS.items()):
+        print(f"{name:<28}{len(values):>9}"
+              f"{percentile(values, 50) * 1000:>10.2f}{percentile(values, 95) * 1000:>10.2f}"
+              f"{percentile(values, 99) * 1000:>10.2f}{max(values) * 1000:>10.2f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100, help="одновременных игроков")
+    parser.add_argument("--moves", type=int, default=30, help="ходов на игрока")
+    parser.add_argument("--typo", type=float, default=0.2, help="доля ходов с опечаткой")
+    parser.add_argument("--wrong-letter", type=float, default=0.05, help="доля ходов не на ту букву")
+    parser.add_argument("--hint", type=float, default=0.1, help="вероятность нажать подсказку")
+    parser.add_argument("--facts", type=float, default=0.2, help="вероятность запросить факты")
+    parser.add_argument("--gemini-latency", type=float, default=1.0, help="задержка заглушки Gemini, с")
+    parser.add_argument("--gemini-errors", type=float, default=0.02, help="доля ошибок Gemini")
+    parser.add_argument("--prefetch", type=float, default=main.FACTS_PREFETCH_RATE,
+                        help="доля ответов бота, к которым справки запрашиваются заранее")
+    parser.add_argument("--prefetch-budget", type=float, default=main.FACTS_PREFETCH_BUDGET,
+                        help="запросов к Gemini в час на предзагрузку")
+    parser.add_argument("--think", type=float, default=0.0, help="пауза игрока перед ходом, с")
+    parser.add_argument("--no-streaming", dest="streaming", action="store_false", help="справка ИИ целиком, без потока")
+    parser.add_argument("--storage", choices=("memory", "paged", "journal", "pickle", "sqlite"), default="paged")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    random.seed(arguments.seed)
+    asyncio.run(run(arguments))
@@ -0,0 +1,29 @@
+"""Сборка снимка каталога городов (cities.catalog) из cities.txt и top_cities.txt.
+
+Бот и сам пересобирает снимок при старте, если исходники поменялись, но при
+нескольких процессах удобнее собрать его заранее, например при деплое.
+
+Запуск: python build_catalog.py
+"""
+import os
+import time
+
+import main
+
+
+def build():
+    start = time.perf_counter()
+    main.write_catalog_snapshot(main.CATALOG_FILE)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    snapshot = main.load_catalog(main.CATALOG_FILE)
+    load_time = time.perf_counter() - start
+
+    print(f"{main.CATALOG_FILE}: {len(snapshot.keys)} городов, {os.path.getsize(main.CATALOG_FILE) / 1024:.0f} КБ, "
+          f"sha256 исходников {snapshot.source_hash.hex()[:16]}")
+    print(f"Сборка: {build_time * 1000:.1f} мс, загрузка снимка: {load_time * 1000:.1f} мс")
+
+
+if __name__ == "__main__":
+    build()
@@ -0,0 +1,244 @@
+"""Локальная проверка webhook-режима без Telegram.
+
+Поднимает заглушку Bot API, запускает бота в режиме webhook с WORKERS процессами
+(Bot ходит в заглушку через TELEGRAM_API_URL) и играет за несколько
+пользователей, отправляя апдейты POST-запросами на webhook. Потом проверяет, что
+у каждого пользователя игра шла без потерь состояния и что его состояние сохранено.
+
+Воркеры пишут в одну базу SQLite (с WORKERS > 1 бот работает только с ней).
+--storage paged проверяет файловое хранилище и возможен только с --workers 1.
+
+С --chat-limit N заглушка, как настоящий Telegram, отвечает 429 с retry_after,
+если в чат пришло больше N сообщений за секунду: так проверяются лимиты и
+повторы исходящих запросов бота.
+
+Запуск: python fake_telegram.py --workers 4 --users 40 --moves 8 [--chat-limit 3] [--storage paged --workers 1]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+from collections import deque
+from typing import Any, Dict, List
+
+import aiohttp
+from aiohttp import web
+
+import main
+
+TOKEN = "123456:FAKE-TOKEN-FOR-LOCAL-WEBHOOK-TEST"
+# Сообщения, которыми заканчивается обработка хода
+FINAL_REPLIES = ("Мой ответ", "Нужно на букву", "уже был", "Не знаю", "Рано сдаешься", "закончились", "победа")
+BOT_INFO = {"id": 123456, "is_bot": True, "first_name": "CitiesBot", "username": "cities_test_bot"}
+
+
+class FakeBotAPI:
+    """Отвечает на любые методы Bot API и запоминает сообщения бота по чатам"""
+
+    def __init__(self, chat_limit: int = 0):
+        self.messages: Dict[int, List[Dict[str, Any]]] = {}
+        self.message_id = 0
+        self.calls = 0
+        # Сообщений в чат за скользящую секунду (0 - без ограничений) и сколько раз ответили 429
+        self.chat_limit = chat_limit
+        self.recent: Dict[int, deque] = {}
+        self.rejected = 0
+
+    def _flood(self, chat_id: int) -> bool:
+        now = time.monotonic()
+        recent = self.recent.setdefault(chat_id, deque())
+        while recent and now - recent[0] > 1:
+            recent.popleft()
+        if len(recent) >= self.chat_limit:
+            return True
+        recent.append(now)
+        return False
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.calls += 1
+        method = request.match_info["method"].lower()
+        params = dict(await request.post())
+
+        if self.chat_limit and "chat_id" in params and self._flood(int(params["chat_id"])):
+            self.rejected += 1
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}}, status=429)
+
+        result: Any = True
+        if method == "getme":
+            result = BOT_INFO
+        elif method in ("sendmessage", "editmessagetext"):
+            chat_id = int(params["chat_id"])
+            self.message_id += 1
+            result = {
+                "message_id": int(params.get("message_id") or self.message_id),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_INFO,
+                "text": re.sub(r"<[^>]+>", "", params.get("text", "")),
+            }
+            markup = json.loads(params["reply_markup"]) if params.get("reply_markup") else None
+            if markup and "inline_keyboard" in markup:
+                result["reply_markup"] = markup
+            self.messages.setdefault(chat_id, []).append(result)
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, port: int) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        return runner
+
+
+def run_bot(config: Dict[str, Any]):
+    """Точка входа процесса с ботом: те же настройки, что в main.py, но локальные"""
+    for name, value in config.items():
+        setattr(main, name, value)
+    # Хранилища по путям из config откроет run_webhook (или каждый воркер у себя)
+    main.run_webhook()
+
+
+class FakeUser:
+
+    def __init__(self, user_id: int, api: FakeBotAPI, http: aiohttp.ClientSession, webhook_url: str, counter):
+        self.user_id = user_id
+        self.api = api
+        self.http = http
+        self.webhook_url = webhook_url
+        self.counter = counter
+        self.rng = random.Random(user_id)
+        self.used = set()
+        self.wrong_letter_replies = 0
+
+    def _next_id(self) -> int:
+        self.counter[0] += 1
+        return self.counter[0]
+
+    async def say(self, text: str) -> List[Dict[str, Any]]:
+        seen = len(self.api.messages.get(self.user_id, []))
+        user = {"id": self.user_id, "is_bot": False, "first_name": f"Игрок {self.user_id}"}
+        update = {
+            "update_id": self._next_id(),
+            "message": {"message_id": self._next_id(), "date": int(time.time()), "text": text,
+                        "chat": {"id": self.user_id, "type": "private"}, "from": user},
+        }
+        async with self.http.post(self.webhook_url, json=update) as response:
+            response.raise_for_status()
+
+        # Ждем последнее сообщение хода (перед ним может прийти, например, "ты имел в виду")
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            replies = self.api.messages.get(self.user_id, [])[seen:]
+            if replies and (text.startswith("/") or any(marker in r["text"] for r in replies for marker in FINAL_REPLIES)):
+                return replies
+            await asyncio.sleep(0.02)
+        raise TimeoutError(f"Нет ответа пользователю {self.user_id} на {text!r}")
+
+    async def play(self, moves: int) -> int:
+        await self.say("/start")
+        letter = None
+        answers = 0
+        for _ in range(moves):
+            keys = [k for k in main.CITIES_KEYS if (not letter or k.startswith(letter)) and k not in self.used]
+            if not keys:
+                break
+            norm = self.rng.choice(keys)
+            self.used.add(norm)
+            replies = await self.say(main.CITIES_MAP[norm])
+            for reply in replies:
+                if "Нужно на букву" in reply["text"]:
+                    self.wrong_letter_replies += 1
+                match = re.search(r"Мой ответ:\s+(.+)", reply["text"])
+                if match:
+                    answers += 1
+                    bot_norm = main.normalize_city(match.group(1).strip())
+                    self.used.add(bot_norm)
+                    letter = main.city_letters(bot_norm)[0]
+        return answers
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="cities-webhook-")
+    api = FakeBotAPI(args.chat_limit)
+    api_runner = await api.start(args.api_port)
+    config = {
+        "TOKEN": TOKEN,
+        "RUN_MODE": "webhook",
+        "WORKERS": args.workers,
+        "WEBHOOK_HOST": "127.0.0.1",
+        "WEBHOOK_PORT": args.webhook_port,
+        "WEBHOOK_BASE_URL": None,
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{args.api_port}",
+        "METRICS_PORT": None,
+        "STORAGE_MODE": args.storage,
+        "STORAGE_PATH": os.path.join(workdir, "bot_state.pkl"),
+        "SQLITE_PATH": os.path.join(workdir, "cities.db"),
+        "HIGHSCORES_FILE": os.path.join(workdir, "highscores.json"),
+        "FACTS_CACHE_FILE": os.path.join(workdir, "city_facts.json"),
+    }
+    bot_process = multiprocessing.Process(target=run_bot, args=(config,))
+    bot_process.start()
+    try:
+        webhook_url = f"http://127.0.0.1:{args.webhook_port}{main.WEBHOOK_PATH}"
+        async with aiohttp.ClientSession() as http:
+            for _ in range(100):
+                try:
+                    async with http.get(webhook_url):
+                        break
+                except aiohttp.ClientConnectionError:
+                    await asyncio.sleep(0.1)
+
+            counter = [0]
+            users = [FakeUser(500000 + i, api, http, webhook_url, counter) for i in range(args.users)]
+            start = time.perf_counter()
+            answers = await asyncio.gather(*(user.play(args.moves) for user in users))
+            elapsed = time.perf_counter() - start
+    finally:
+        bot_process.terminate()
+        bot_process.join(30)
+        await api_runner.cleanup()
+
+    # Состояние каждого пользователя должно быть сохранено
+    if args.storage == "sqlite":
+        with sqlite3.connect(config["SQLITE_PATH"]) as db:
+            saved = {user_id for (user_id,) in db.execute("SELECT user_id FROM sessions WHERE state IS NOT NULL")}
+    else:
+        saved = set(main.JournalFileStorage(config["STORAGE_PATH"]).data)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    missing = [u.user_id for u in users if u.user_id not in saved]
+    lost = sum(u.wrong_letter_replies for u in users)
+    print(f"Воркеров: {args.workers}, пользователей: {args.users}, ответов бота: {sum(answers)}, "
+          f"вызовов Bot API: {api.calls}, сообщений бота: {sum(map(len, api.messages.values()))}, "
+          f"ответов 429: {api.rejected}, время: {elapsed:.2f} с")
+    print(f"Ответов 'Нужно на букву' (потеря состояния): {lost}; пользователей без сохраненного состояния: {len(missing)}")
+    return not lost and not missing
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--users", type=int, default=40)
+    parser.add_argument("--moves", type=int, default=8)
+    parser.add_argument("--api-port", type=int, default=8181)
+    parser.add_argument("--webhook-port", type=int, default=8182)
+    parser.add_argument("--chat-limit", type=int, default=0, help="сообщений в чат в секунду, дальше 429")
+    parser.add_argument("--storage", choices=("paged", "sqlite"), default="sqlite")
+    args = parser.parse_args()
+    if args.storage != "sqlite" and args.workers > 1:
+        parser.error("с --workers > 1 бот работает только с --storage sqlite")
+    return args
+
+
+if __name__ == "__main__":
+    ok = asyncio.run(run(parse_args()))
+    raise SystemExit(0 if ok else 1)
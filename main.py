@@ -1,33 +1,266 @@
 import asyncio
+import bisect
+import copy
 import logging
 import random
 import re
 import os
 import json
+import html
 import pickle
-from typing import Dict, Any, Optional
-
-from aiogram import Bot, Dispatcher, types, F
+import hashlib
+import multiprocessing
+import signal
+import zlib
+import time
+import heapq
+import sqlite3
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Dict, Any, Optional, List, Tuple
+
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import Command
+from aiogram.methods import EditMessageReplyMarkup, EditMessageText, SendChatAction
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, \
     CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, StorageKey, StateType
 
+from aiohttp import web
 from thefuzz import process, fuzz
+
+try:
+    import fcntl  # блокировка реестра id при перезагрузке каталога в нескольких процессах
+except ImportError:  # Windows
+    fcntl = None
 import google.generativeai as genai
 
 # --- КОНФИГУРАЦИЯ ---
 TOKEN = "ВАШ ТОКЕН БОТА (bot_father)"
 GEMINI_KEY = "ВАШ API КЛЮЧ"
 
+# Справки ИИ: кэш по городам и ограничения на запросы к Gemini
+FACTS_CACHE_FILE = "city_facts.json"
+FACTS_TTL = 30 * 24 * 3600
+FACTS_MAX_ITEMS = 20000
+GEMINI_CONCURRENCY = 8
+GEMINI_TIMEOUT = 20
+# Показывать справку по мере генерации, правя сообщение не чаще раза в FACTS_EDIT_INTERVAL секунд
+FACTS_STREAMING = True
+FACTS_EDIT_INTERVAL = 1.2
+# Предзагрузка справок к ответу бота до нажатия кнопки: доля ответов (0 - выключено),
+# запросов к Gemini в час на нее, сколько одновременно, сколько ждут в очереди и сколько живет результат
+FACTS_PREFETCH_RATE = 0.3
+FACTS_PREFETCH_BUDGET = 600
+FACTS_PREFETCH_CONCURRENCY = 2
+FACTS_PREFETCH_QUEUE = 100
+FACTS_PREFETCH_TTL = 120
+
+# Скомпилированный снимок каталога городов (пересобирается автоматически, см. build_catalog.py)
+CATALOG_FILE = "cities.catalog"
+
+# Реестр целочисленных id городов (номер строки = id), только дописывается. Это данные бота, а не исходники:
+# не затирайте его при выкладке, иначе used_ids сохраненных игр укажут не на те города.
+# None - рядом с хранилищем, STORAGE_PATH + ".ids". Пока в каталоге нет городов сверх CITY_IDS_SEED
+# (id городов из репозитория, этот файл только читается), реестр не создается - id берутся из него.
+CITY_IDS_FILE: Optional[str] = None
+CITY_IDS_SEED = "city_ids.txt"
+
+# Как часто проверять, не поменялись ли cities.txt и top_cities.txt (None - не следить, только /reload_catalog)
+CATALOG_WATCH_INTERVAL = 10
+# user_id, которым доступны служебные команды (/reload_catalog)
+ADMIN_IDS: List[int] = []
+
+# Метрики Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (METRICS_PORT = None - выключено)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+
+# Режим работы: "polling" - один процесс опрашивает Telegram, "webhook" - aiohttp-сервер
+RUN_MODE = "polling"
+WEBHOOK_BASE_URL = None  # публичный адрес, например "https://bot.example.com"; None - не вызывать setWebhook
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = None
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+# Сколько апдейтов один процесс обрабатывает одновременно
+WEBHOOK_CONCURRENCY = 64
+# Процессов-обработчиков: апдейты распределяются по хэшу user_id, у каждого свое хранилище.
+# Больше одного - только со STORAGE_MODE = "sqlite": рекорды и кэш фактов должны быть общими
+WORKERS = 1
+# Свой Bot API сервер (например, локальная заглушка из fake_telegram.py); None - api.telegram.org
+TELEGRAM_API_URL = None
+
+# Хранилище состояний: "paged" - журнал, в памяти только активные игроки, остальные в файлах по одному;
+# "journal" - снимок + журнал изменений, все в памяти; "pickle" - полная перезапись файла;
+# "sqlite" - состояния, рекорды и кэш фактов в общей базе SQLITE_PATH (одна на все процессы хоста,
+# см. migrate_sqlite.py)
+STORAGE_MODE = "paged"
+STORAGE_PATH = "bot_state.pkl"
+SQLITE_PATH = "cities.db"
+# Для "paged": через сколько секунд без апдейтов игрок выгружается на диск, сколько игроков
+# держать в памяти максимум и через сколько секунд брошенная игра удаляется совсем
+SESSION_IDLE_TTL = 3600
+SESSION_MAX_HOT = 50000
+SESSION_EXPIRE = 90 * 24 * 3600
+
+# Лимиты исходящих запросов к Bot API: сообщений в секунду на весь бот и на один чат
+FLOOD_GLOBAL_RATE = 25
+FLOOD_CHAT_RATE = 1
+FLOOD_CHAT_BURST = 3
+# Сколько раз повторять запрос после ответа 429 (retry_after)
+FLOOD_MAX_RETRIES = 3
+
 genai.configure(api_key=GEMINI_KEY.strip())
 model = genai.GenerativeModel('gemini-2.5-flash')
 
 logging.basicConfig(level=logging.INFO)
 
 
+# --- МЕТРИКИ ---
+class Metrics:
+    """Счетчики, гистограммы и gauge в формате Prometheus (text exposition)"""
+
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self._meta: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+        self._histograms: Dict[Tuple[str, Tuple], List[float]] = {}
+        self._gauges: Dict[str, Any] = {}
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        # [счетчики по корзинам..., сумма, количество]
+        hist = self._histograms.get(key)
+        if hist is None:
+            hist = self._histograms[key] = [0] * (len(self.LATENCY_BUCKETS) + 2)
+        for i, bound in enumerate(self.LATENCY_BUCKETS):
+            if value <= bound:
+                hist[i] += 1
+        hist[-2] += value
+        hist[-1] += 1
+
+    def gauge(self, name: str, func):
+        """Gauge, значение которого вычисляется в момент запроса метрик"""
+        self._gauges[name] = func
+
+    @staticmethod
+    def _labels(labels: Tuple) -> str:
+        if not labels:
+            return ""
+        parts = []
+        for k, v in labels:
+            value = str(v).replace("\\", "\\\\").replace('"', '\\"')
+            parts.append(f'{k}="{value}"')
+        return "{" + ",".join(parts) + "}"
+
+    def render(self) -> str:
+        lines: List[str] = []
+        written = set()
+
+        def header(name: str, default_kind: str):
+            if name in written:
+                return
+            written.add(name)
+            kind, help_text = self._meta.get(name, (default_kind, name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self._counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+
+        for (name, labels), hist in sorted(self._histograms.items()):
+            header(name, "histogram")
+            for bound, count in zip(self.LATENCY_BUCKETS, hist):
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {count}")
+            lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {hist[-1]}")
+            lines.append(f"{name}_sum{self._labels(labels)} {hist[-2]}")
+            lines.append(f"{name}_count{self._labels(labels)} {hist[-1]}")
+
+        for name, func in sorted(self._gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                logging.error(f"Error computing metric {name}: {e}")
+                continue
+            header(name, "gauge")
+            lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+METRICS.describe("cities_handler_seconds", "histogram", "Время работы обработчика апдейта")
+METRICS.describe("cities_handler_errors_total", "counter", "Исключения в обработчиках")
+METRICS.describe("cities_match_total", "counter", "Результаты find_best_match: exact, phonetic, fuzzy, miss")
+METRICS.describe("cities_fuzzy_match_seconds", "histogram", "Время нечеткого поиска города")
+METRICS.describe("cities_gemini_seconds", "histogram", "Время запроса к Gemini")
+METRICS.describe("cities_gemini_requests_total", "counter", "Запросы к Gemini по результату")
+METRICS.describe("cities_gemini_first_chunk_seconds", "histogram", "Время до первого куска ответа Gemini")
+METRICS.describe("cities_facts_first_edit_seconds", "histogram", "От нажатия кнопки фактов до первого текста")
+METRICS.describe("cities_facts_prefetch_total", "counter", "Предзагрузки справок по исходу")
+METRICS.describe("cities_storage_save_seconds", "histogram", "Время записи хранилища на диск")
+METRICS.describe("cities_storage_save_bytes_total", "counter", "Байт записано хранилищем")
+METRICS.describe("cities_storage_sessions_total", "counter", "Игроки, выгруженные на диск, загруженные обратно и удаленные")
+METRICS.describe("cities_storage_hot_sessions", "gauge", "Игроки, чье состояние сейчас в памяти")
+METRICS.describe("cities_active_games", "gauge", "Пользователи в состоянии игры")
+METRICS.describe("cities_catalog_version", "gauge", "Номер загруженной версии каталога (с 1 при запуске)")
+METRICS.describe("cities_catalog_cities", "gauge", "Городов в загруженной версии каталога")
+METRICS.describe("cities_catalog_reloads_total", "counter", "Перезагрузки каталога по результату")
+METRICS.describe("cities_outbound_wait_seconds", "histogram", "Ожидание лимита перед запросом к Bot API")
+METRICS.describe("cities_outbound_retry_after_total", "counter", "Ответы 429 от Bot API")
+METRICS.describe("cities_outbound_dropped_total", "counter", "Необязательные запросы, пропущенные из-за лимита")
+METRICS.describe("cities_outbound_merged_total", "counter", "Сообщения, склеенные с предыдущим в том же апдейте")
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Замеряет время каждого обработчика (ставится на dp.message и dp.callback_query)"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unhandled"
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            METRICS.inc("cities_handler_errors_total", handler=name)
+            raise
+        finally:
+            METRICS.observe("cities_handler_seconds", time.perf_counter() - start, handler=name)
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    async def metrics_handler(request: web.Request) -> web.Response:
+        return web.Response(text=METRICS.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
+
+
 class PickleFileStorage(BaseStorage):
 
     def __init__(self, path: str = "bot_state.pkl"):
@@ -45,14 +278,20 @@ class PickleFileStorage(BaseStorage):
             return {}
 
     def _save(self):
+        start = time.perf_counter()
         try:
             with open(self.path, "wb") as f:
                 pickle.dump(self.data, f)
+                METRICS.inc("cities_storage_save_bytes_total", f.tell(), kind="snapshot")
         except Exception as e:
             logging.error(f"Error saving storage: {e}")
+        METRICS.observe("cities_storage_save_seconds", time.perf_counter() - start, kind="snapshot")
+
+    def count_states(self, state: str) -> int:
+        return sum(1 for entry in self.data.values() if entry.get("state") == state)
 
     async def set_state(self, key: StorageKey, state: StateType = None) -> None:
-        self.data.setdefault(key.user_id, {})["state"] = state.state if state else None
+        self.data.setdefault(key.user_id, {})["state"] = state.state if isinstance(state, State) else state
         self._save()
 
     async def get_state(self, key: StorageKey) -> Optional[str]:
@@ -69,36 +308,843 @@ class PickleFileStorage(BaseStorage):
         pass
 
 
-HIGHSCORES_FILE = "highscores.json"
+class JournalFileStorage(PickleFileStorage):
+    """Снимок (pickle) + журнал изменений по пользователям.
+
+    Каждое изменение состояния или данных пользователя попадает в буфер, а буфер
+    дописывается в журнал одной записью раз в flush_interval секунд или при
+    накоплении batch_size изменений. Когда журнал разрастается, он сворачивается
+    в новый снимок. При запуске состояние = снимок + проигрывание журнала.
+    Запись журнала (с fsync) и свертка идут в отдельном потоке, апдейты их не ждут.
+    """
+
+    def __init__(self, path: str = "bot_state.pkl", flush_interval: float = 0.5, batch_size: int = 256,
+                 compact_bytes: int = 16 * 1024 * 1024):
+        self.log_path = path + ".log"
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.compact_bytes = compact_bytes
+        self._pending: Dict[Tuple[Any, str], Any] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._compact_due = False
+        self._log_size = 0
+        super().__init__(path)
+        self._replay_log()
+
+    def _replay_log(self):
+        if not os.path.exists(self.log_path):
+            return
+        good_offset = 0
+        records = 0
+        try:
+            with open(self.log_path, "rb") as f:
+                while True:
+                    header = f.read(4)
+                    if len(header) < 4:
+                        break
+                    payload = f.read(int.from_bytes(header, "little"))
+                    if len(payload) < int.from_bytes(header, "little"):
+                        break
+                    for user_id, field, value in pickle.loads(payload):
+                        self.data.setdefault(user_id, {})[field] = value
+                        records += 1
+                    good_offset = f.tell()
+        except Exception as e:
+            logging.error(f"Error replaying storage journal: {e}")
+
+        # Недописанный хвост после падения просто отрезаем
+        if good_offset != os.path.getsize(self.log_path):
+            logging.warning(f"Storage journal truncated at {good_offset} bytes")
+            with open(self.log_path, "r+b") as f:
+                f.truncate(good_offset)
+        self._log_size = good_offset
+        logging.info(f"Storage journal replayed: {records} records")
+
+    def _append(self, user_id: Any, field: str, value: Any):
+        # Несколько изменений одного поля до сброса схлопываются в одно
+        self._pending[(user_id, field)] = value
+        if self._flush_task is not None:
+            return  # текущая запись заберет и это изменение
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._flush()
+            return
+        if len(self._pending) >= self.batch_size:
+            self._start_flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.flush_interval, self._start_flush)
+
+    def _start_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_async())
+
+    async def _flush_async(self):
+        """Пишет буфер в журнал и сворачивает снимок в потоке. Задача одна на хранилище,
+        поэтому свертка не обрежет журнал, в который в это же время что-то дописывается."""
+        try:
+            while self._pending or self._compact_due:
+                payload = self._take_batch() if self._pending else None
+                snapshot = None
+                if self._compact_due or self._log_size + 4 + len(payload or b"") >= self.compact_bytes:
+                    # Снимок берется вместе с пачкой, до await: в нем ровно то же, что в журнале
+                    # после этой пачки. Иначе при падении между подменой снимка и обрезкой журнала
+                    # старые записи журнала проиграются поверх более нового снимка.
+                    self._compact_due = False
+                    snapshot = self._snapshot()
+                if payload is not None:
+                    start = time.perf_counter()
+                    written = await asyncio.to_thread(self._write_journal, payload)
+                    self._observe_write("journal", start, written)
+                if snapshot is not None:
+                    start = time.perf_counter()
+                    written = await asyncio.to_thread(self._write_snapshot, snapshot)
+                    self._observe_write("snapshot", start, written)
+        finally:
+            self._flush_task = None
+
+    async def _drain(self, compact: bool = False):
+        """Дописать буфер в журнал (и, если compact, свернуть снимок) и дождаться записи"""
+        self._compact_due = self._compact_due or compact
+        self._start_flush()
+        await self._flush_task
+
+    def _flush(self):
+        """То же без цикла событий: прямо в вызывающем потоке"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._pending:
+            start = time.perf_counter()
+            self._observe_write("journal", start, self._write_journal(self._take_batch()))
+        if self._log_size >= self.compact_bytes:
+            self._save()
 
+    def _save(self):
+        start = time.perf_counter()
+        self._observe_write("snapshot", start, self._write_snapshot(self._snapshot()))
 
-def get_high_score(user_id: int) -> int:
-    if not os.path.exists(HIGHSCORES_FILE):
-        return 0
+    def _take_batch(self) -> bytes:
+        records = [(user_id, field, value) for (user_id, field), value in self._pending.items()]
+        self._pending.clear()
+        return pickle.dumps(records)
+
+    def _snapshot(self) -> bytes:
+        # Сериализуем здесь, в цикле событий: обработчики меняют self.data (и данные игр на месте),
+        # поэтому в поток уходят только готовые байты
+        return pickle.dumps(self.data)
+
+    def _write_journal(self, payload: bytes) -> int:
+        try:
+            with open(self.log_path, "ab") as f:
+                f.write(len(payload).to_bytes(4, "little") + payload)
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as e:
+            logging.error(f"Error writing storage journal: {e}")
+            return 0
+        self._log_size += 4 + len(payload)
+        return 4 + len(payload)
+
+    def _write_snapshot(self, snapshot: bytes) -> int:
+        """Сворачивает журнал в снимок: пишем во временный файл и атомарно подменяем"""
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+                size = len(snapshot)
+            os.replace(tmp_path, self.path)
+            with open(self.log_path, "wb"):
+                pass
+            self._log_size = 0
+            return size
+        except Exception as e:
+            logging.error(f"Error compacting storage: {e}")
+            return 0
+
+    @staticmethod
+    def _observe_write(kind: str, start: float, written: int):
+        METRICS.observe("cities_storage_save_seconds", time.perf_counter() - start, kind=kind)
+        METRICS.inc("cities_storage_save_bytes_total", written, kind=kind)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        self.data.setdefault(key.user_id, {})["state"] = value
+        self._append(key.user_id, "state", value)
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        self.data.setdefault(key.user_id, {})["data"] = data
+        self._append(key.user_id, "data", data)
+
+    async def close(self) -> None:
+        await self._drain(compact=True)
+
+
+class PagedJournalStorage(JournalFileStorage):
+    """Журнал, но в памяти (и в снимке) только игроки, которые недавно писали боту.
+
+    Кто не писал idle_ttl секунд (или не влез в max_hot), выгружается в свой файл
+    в каталоге path + ".users" и читается обратно при следующем get_state/get_data.
+    Игра, брошенная на expire секунд, удаляется. Память и время свертки снимка
+    зависят от числа одновременно играющих, а не от всех, кто когда-либо заходил.
+    """
+
+    # Как часто проходить по каталогу и удалять файлы брошенных игр
+    DISK_SWEEP_INTERVAL = 24 * 3600
+
+    def __init__(self, path: str = "bot_state.pkl", idle_ttl: float = 3600, max_hot: int = 50000,
+                 expire: float = 90 * 24 * 3600, sweep_interval: float = 60, **kwargs):
+        self.users_dir = path + ".users"
+        self.idle_ttl = idle_ttl
+        self.max_hot = max_hot
+        self.expire = expire
+        self.sweep_interval = sweep_interval
+        super().__init__(path, **kwargs)
+        # От давно не заходивших к недавним; у записей из старых снимков времени нет - считаем, что только что
+        now = time.time()
+        for entry in self.data.values():
+            entry.setdefault("seen", now)
+        self.data: "OrderedDict[Any, Dict[str, Any]]" = OrderedDict(
+            sorted(self.data.items(), key=lambda item: item[1]["seen"]))
+        self._last_sweep = time.monotonic()
+        self._last_disk_sweep = 0.0
+        # Ссылка на задачу обязательна: задачу, на которую никто не ссылается, сборщик может удалить посреди работы
+        self._sweep_task: Optional[asyncio.Task] = None
+
+    def _user_path(self, user_id: Any) -> str:
+        return os.path.join(self.users_dir, f"{zlib.crc32(str(user_id).encode()) % 256:02x}", f"{user_id}.pkl")
+
+    def _page_in(self, user_id: Any) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._user_path(user_id), "rb") as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.error(f"Error loading session {user_id}: {e}")
+            return None
+        if time.time() - entry.get("seen", 0) >= self.expire:
+            METRICS.inc("cities_storage_sessions_total", event="expired")
+            try:
+                os.remove(self._user_path(user_id))
+            except OSError:
+                pass
+            return None
+        METRICS.inc("cities_storage_sessions_total", event="paged_in")
+        # Игрока нет в снимке: пишем его в журнал целиком, чтобы после сбоя не собрать его по частям
+        for field in ("state", "data"):
+            if field in entry:
+                self._append(user_id, field, entry[field])
+        return entry
+
+    def _entry(self, user_id: Any) -> Dict[str, Any]:
+        entry = self.data.get(user_id)
+        if entry is None:
+            # Пустая запись тоже остается в памяти, чтобы не искать файл на каждом апдейте незнакомца
+            entry = self.data[user_id] = self._page_in(user_id) or {}
+        else:
+            self.data.move_to_end(user_id)
+        entry["seen"] = time.time()
+        if time.monotonic() - self._last_sweep >= self.sweep_interval and self._sweep_task is None:
+            self._sweep_task = asyncio.get_running_loop().create_task(self._sweep())
+        return entry
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        self._entry(key.user_id)["state"] = value
+        self._append(key.user_id, "state", value)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._entry(key.user_id).get("state")
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        self._entry(key.user_id)["data"] = data
+        self._append(key.user_id, "data", data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return self._entry(key.user_id).get("data", {})
+
+    async def _sweep(self):
+        """Выгружает остывших игроков на диск, удаляет брошенные игры и сворачивает журнал"""
+        try:
+            now = time.time()
+            cold: List[Tuple[Any, Dict[str, Any], bytes]] = []
+            expired: List[Tuple[Any, Dict[str, Any]]] = []
+            empty: List[Tuple[Any, Dict[str, Any]]] = []
+            hot = len(self.data)
+            for user_id, entry in self.data.items():
+                idle = now - entry["seen"]
+                if idle < self.idle_ttl and hot <= self.max_hot:
+                    break
+                hot -= 1
+                if not ("state" in entry or "data" in entry):
+                    empty.append((user_id, entry))
+                elif idle >= self.expire:
+                    expired.append((user_id, entry))
+                else:
+                    cold.append((user_id, entry, pickle.dumps(entry)))
+
+            disk_sweep = time.monotonic() - self._last_disk_sweep >= self.DISK_SWEEP_INTERVAL
+            if cold or expired or empty or disk_sweep:
+                # Изменения выгружаемых игроков должны попасть в журнал до свертки снимка без них
+                await self._drain()
+                removed = await asyncio.to_thread(self._write_cold, [(user_id, payload) for user_id, _, payload in cold],
+                                                  [user_id for user_id, _ in expired], disk_sweep)
+                if disk_sweep:
+                    self._last_disk_sweep = time.monotonic()
+
+                # Кто успел написать боту, пока шла запись, остается в памяти
+                paged_out = 0
+                for user_id, entry, *_ in cold + expired + empty:
+                    if self.data.get(user_id) is entry and entry["seen"] <= now:
+                        del self.data[user_id]
+                        paged_out += 1
+                METRICS.inc("cities_storage_sessions_total", len(cold), event="paged_out")
+                METRICS.inc("cities_storage_sessions_total", len(expired) + removed, event="expired")
+                if paged_out:
+                    await self._drain(compact=True)
+                logging.info(f"Storage sweep: {len(cold)} paged out, {len(expired) + removed} expired, "
+                             f"{len(self.data)} in memory")
+        except Exception as e:
+            logging.error(f"Error sweeping storage: {e!r}")
+        finally:
+            self._last_sweep = time.monotonic()
+            self._sweep_task = None
+
+    def _write_cold(self, cold: List[Tuple[Any, bytes]], expired: List[Any], disk_sweep: bool) -> int:
+        """В потоке: файлы остывших игроков пишутся атомарно, файлы брошенных игр удаляются.
+        disk_sweep - еще и пройти по каталогу и удалить файлы, которые не трогали expire секунд."""
+        for user_id, payload in cold:
+            path = self._user_path(user_id)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
+        for user_id in expired:
+            try:
+                os.remove(self._user_path(user_id))
+            except FileNotFoundError:
+                pass
+
+        removed = 0
+        if disk_sweep and os.path.isdir(self.users_dir):
+            deadline = time.time() - self.expire
+            for root, _, files in os.walk(self.users_dir):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        if os.path.getmtime(path) < deadline:
+                            os.remove(path)
+                            removed += 1
+                    except FileNotFoundError:
+                        pass
+        return removed
+
+    async def close(self) -> None:
+        if self._sweep_task is not None:
+            await self._sweep_task
+        await super().close()
+
+
+# ОБЩАЯ БАЗА SQLITE
+class SqliteConnection:
+    """Соединение с базой в своем потоке. sqlite3 блокирует, поэтому запросы выполняются
+    в однопоточном executor, а цикл событий только ждет результат (run)."""
+
+    def __init__(self, path: str, schema: str, busy_timeout: float = 10.0):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn: Optional[sqlite3.Connection] = None
+        self.call(self._open, schema, busy_timeout)
+
+    def _open(self, _, schema: str, busy_timeout: float):
+        # isolation_level=None: транзакции открываем сами (BEGIN IMMEDIATE), чтобы писать пачками
+        conn = sqlite3.connect(self.path, timeout=busy_timeout, isolation_level=None, cached_statements=64)
+        # WAL: читатели (другие процессы, бэкап) не мешают писателю; NORMAL - без fsync на каждый коммит
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(schema)
+        self._conn = conn
+
+    def call(self, fn, *args):
+        """fn(conn, *args) в потоке базы; вызывающий поток ждет (запуск, остановка, миграция)"""
+        return self._executor.submit(lambda: fn(self._conn, *args)).result()
+
+    async def run(self, fn, *args):
+        return await asyncio.wrap_future(self._executor.submit(lambda: fn(self._conn, *args)))
+
+    def close(self):
+        if self._conn is not None:
+            self.call(lambda conn: conn.close())
+            self._conn = None
+        self._executor.shutdown()
+
+
+def _write_transaction(conn: sqlite3.Connection, statements: List[Tuple[str, List[tuple]]]):
+    """Все изменения пачки одной транзакцией; executemany готовит каждый запрос один раз"""
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        with open(HIGHSCORES_FILE, "r", encoding="utf-8") as f:
-            scores = json.load(f)
-            return scores.get(str(user_id), 0)
-    except:
-        return 0
+        for sql, rows in statements:
+            if rows:
+                conn.executemany(sql, rows)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+_SESSIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    user_id INTEGER PRIMARY KEY,
+    state TEXT,
+    data BLOB,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_state ON sessions (state);
+CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated);
+"""
+_SQL_SET_STATE = ("INSERT INTO sessions (user_id, state, updated) VALUES (?, ?, ?) "
+                  "ON CONFLICT (user_id) DO UPDATE SET state = excluded.state, updated = excluded.updated")
+_SQL_SET_DATA = ("INSERT INTO sessions (user_id, data, updated) VALUES (?, ?, ?) "
+                 "ON CONFLICT (user_id) DO UPDATE SET data = excluded.data, updated = excluded.updated")
+_SQL_IMPORT_SESSION = ("INSERT INTO sessions (user_id, state, data, updated) VALUES (?, ?, ?, ?) "
+                       "ON CONFLICT (user_id) DO UPDATE SET state = excluded.state, data = excluded.data, "
+                       "updated = excluded.updated WHERE excluded.updated >= sessions.updated")
+_SQL_GET_SESSION = "SELECT state, data FROM sessions WHERE user_id = ?"
+_SQL_EXPIRE_SESSIONS = "DELETE FROM sessions WHERE updated < ?"
+_SQL_COUNT_STATES = "SELECT state, COUNT(*) FROM sessions WHERE state IS NOT NULL GROUP BY state"
+
+
+class SqliteStorage(BaseStorage):
+    """Состояния и данные игроков в SQLite (WAL) - одна база на все процессы хоста.
+
+    Изменения копятся в буфере, как в JournalFileStorage, и уходят в базу одной
+    транзакцией раз в flush_interval секунд или по batch_size изменений. Пока
+    изменение не закоммичено, чтения берут его из буфера. Игры, которые не
+    менялись expire секунд, удаляются.
+
+    Последние max_hot игроков держатся в памяти, чтобы апдейт не ждал потока базы.
+    Это безопасно, пока апдейты одного игрока приходят в один процесс (shard_for).
+    """
+
+    # Как часто удалять брошенные игры и пересчитывать игроков по состояниям
+    SWEEP_INTERVAL = 24 * 3600
+    COUNT_INTERVAL = 15
+
+    def __init__(self, path: str = SQLITE_PATH, flush_interval: float = 0.5, batch_size: int = 256,
+                 expire: float = 90 * 24 * 3600, max_hot: int = 50000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.expire = expire
+        self.max_hot = max_hot
+        self.db = SqliteConnection(path, _SESSIONS_SCHEMA)
+        # user_id -> {"state": ..., "data": ...}, от давно не заходивших к недавним
+        self._hot: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._pending: Dict[Tuple[int, str], Any] = {}
+        self._writing: Dict[Tuple[int, str], Any] = {}  # пачка, которая сейчас пишется в базу
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._state_counts: Dict[str, int] = {}
+        self._last_count = 0.0
+        self._last_sweep = 0.0
+
+    def _append(self, user_id: int, field: str, value: Any):
+        self._pending[(user_id, field)] = value
+        if self._flush_task is not None:
+            return  # текущая запись заберет и это изменение
+        if len(self._pending) >= self.batch_size:
+            self._start_flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self._start_flush)
+
+    def _start_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        try:
+            while self._pending:
+                self._writing, self._pending = self._pending, {}
+                # Данные сериализуем здесь: в потоке базы обработчик мог бы менять их одновременно
+                now = time.time()
+                states = [(user_id, value, now)
+                          for (user_id, field), value in self._writing.items() if field == "state"]
+                blobs = [(user_id, pickle.dumps(value), now)
+                         for (user_id, field), value in self._writing.items() if field == "data"]
+                start = time.perf_counter()
+                try:
+                    await self.db.run(self._write, states, blobs, now)
+                except Exception as e:
+                    logging.error(f"Error writing sqlite storage: {e}")
+                    # Изменения не теряем: вернутся в базу со следующей записью
+                    for key, value in self._writing.items():
+                        self._pending.setdefault(key, value)
+                    break
+                finally:
+                    self._writing = {}
+                    METRICS.observe("cities_storage_save_seconds", time.perf_counter() - start, kind="sqlite")
+                METRICS.inc("cities_storage_save_bytes_total", sum(len(blob) for _, blob, _ in blobs), kind="sqlite")
+        finally:
+            self._flush_task = None
+
+    def _write(self, conn: sqlite3.Connection, states: List[tuple], blobs: List[tuple], now: float):
+        _write_transaction(conn, [(_SQL_SET_STATE, states), (_SQL_SET_DATA, blobs)])
+        if self.expire and now - self._last_sweep >= self.SWEEP_INTERVAL:
+            self._last_sweep = now
+            expired = conn.execute(_SQL_EXPIRE_SESSIONS, (now - self.expire,)).rowcount
+            if expired:
+                logging.info(f"Удалено брошенных игр: {expired}")
+        if now - self._last_count >= self.COUNT_INTERVAL:
+            self._last_count = now
+            self._state_counts = dict(conn.execute(_SQL_COUNT_STATES).fetchall())
+
+    @staticmethod
+    def _read(conn: sqlite3.Connection, user_id: int) -> Tuple[Optional[str], Dict[str, Any]]:
+        row = conn.execute(_SQL_GET_SESSION, (user_id,)).fetchone()
+        if row is None:
+            return None, {}
+        state, blob = row
+        return state, pickle.loads(blob) if blob else {}
+
+    async def _entry(self, user_id: int) -> Dict[str, Any]:
+        entry = self._hot.get(user_id)
+        if entry is None:
+            state, data = await self.db.run(self._read, user_id)
+            # Пока ждали базу, запись этого же игрока могла попасть в буфер или в память
+            entry = self._hot.get(user_id)
+            if entry is None:
+                entry = self._hot[user_id] = {"state": state, "data": data}
+                for field in ("state", "data"):
+                    for buffer in (self._writing, self._pending):
+                        if (user_id, field) in buffer:
+                            entry[field] = buffer[(user_id, field)]
+                if len(self._hot) > self.max_hot:
+                    self._hot.popitem(last=False)
+        self._hot.move_to_end(user_id)
+        return entry
+
+    def _set(self, user_id: int, field: str, value: Any):
+        entry = self._hot.get(user_id)
+        if entry is not None:
+            entry[field] = value
+        self._append(user_id, field, value)
+
+    def count_states(self, state: str) -> int:
+        """Игроков в состоянии по всей базе (то есть по всем процессам), пересчет раз в COUNT_INTERVAL"""
+        return self._state_counts.get(state, 0)
+
+    def import_sessions(self, sessions: List[Tuple[int, Optional[str], Dict[str, Any], float]]):
+        """Перенос игр из старых хранилищ (migrate_sqlite.py): (user_id, state, data, время).
+        Более свежая запись в базе не перезаписывается."""
+        rows = [(user_id, state, pickle.dumps(data), updated) for user_id, state, data, updated in sessions]
+        self.db.call(_write_transaction, [(_SQL_IMPORT_SESSION, rows)])
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self._set(key.user_id, "state", state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._entry(key.user_id))["state"]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        self._set(key.user_id, "data", data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._entry(key.user_id))["data"]
+
+    async def close(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_task is not None:
+            await self._flush_task
+        if self._pending:
+            await self._flush()
+        self.db.close()
+
+
+def make_storage(path: str = STORAGE_PATH) -> BaseStorage:
+    if STORAGE_MODE == "sqlite":
+        # Путь к файлам воркеров не нужен: база одна на все процессы
+        return SqliteStorage(SQLITE_PATH, expire=SESSION_EXPIRE, max_hot=SESSION_MAX_HOT)
+    if STORAGE_MODE == "paged":
+        return PagedJournalStorage(path, SESSION_IDLE_TTL, SESSION_MAX_HOT, SESSION_EXPIRE)
+    if STORAGE_MODE == "journal":
+        return JournalFileStorage(path)
+    return PickleFileStorage(path)
+
+
+HIGHSCORES_FILE = "highscores.json"
+
 
+class JsonWriteBehind(ABC):
+    """Фоновая запись JSON-файла: все изменения за flush_delay секунд уходят на диск
+    одной записью в отдельном потоке, файл подменяется атомарно."""
 
-def save_high_score(user_id: int, score: int):
-    scores = {}
-    if os.path.exists(HIGHSCORES_FILE):
+    def __init__(self, path: str, flush_delay: float = 2.0):
+        self.path = path
+        self.flush_delay = flush_delay
+        self._dirty = False
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+    @abstractmethod
+    def _dump(self) -> Any:
+        """Содержимое файла: то, что уйдет в json.dumps"""
+
+    def _read(self) -> Optional[Any]:
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            logging.error(f"Error loading {self.path}: {e}")
+            return None
+
+    def _mark_dirty(self):
+        self._dirty = True
+        if self._flush_handle is not None or self._flush_task is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write()
+            return
+        self._flush_handle = loop.call_later(self.flush_delay, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
         try:
-            with open(HIGHSCORES_FILE, "r", encoding="utf-8") as f:
-                scores = json.load(f)
-        except:
-            scores = {}
-
-    current_high = scores.get(str(user_id), 0)
-    if score > current_high:
-        scores[str(user_id)] = score
-        with open(HIGHSCORES_FILE, "w", encoding="utf-8") as f:
-            json.dump(scores, f)
+            while self._dirty:
+                self._dirty = False
+                snapshot = json.dumps(self._dump(), ensure_ascii=False)
+                await asyncio.to_thread(self._write_text, snapshot)
+        finally:
+            self._flush_task = None
+
+    def _write(self):
+        self._dirty = False
+        self._write_text(json.dumps(self._dump(), ensure_ascii=False))
+
+    def _write_text(self, text: str):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logging.error(f"Error saving {self.path}: {e}")
+
+    async def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_task is not None:
+            await self._flush_task
+        if self._dirty:
+            self._write()
+
+
+class HighScores(JsonWriteBehind):
+    """Рекорды в памяти: файл читается один раз, рейтинг хранится отсортированным,
+    а на диск изменения уходят в фоне."""
+
+    def __init__(self, path: str = HIGHSCORES_FILE, flush_delay: float = 2.0):
+        super().__init__(path, flush_delay)
+        self.scores: Dict[str, int] = {}
+        self.names: Dict[str, str] = {}
+        # (-счет, user_id) по возрастанию = рейтинг от лучшего к худшему
+        self.ranking: List[Tuple[int, str]] = []
+        self._load()
+
+    def _load(self):
+        raw = self._read()
+        if not raw:
+            return
+        # Старый формат файла - просто {user_id: счет}
+        if "scores" in raw and isinstance(raw["scores"], dict):
+            self.scores = {str(k): int(v) for k, v in raw["scores"].items()}
+            self.names = {str(k): v for k, v in raw.get("names", {}).items()}
+        else:
+            self.scores = {str(k): int(v) for k, v in raw.items()}
+        self.ranking = sorted((-score, uid) for uid, score in self.scores.items())
+
+    def _dump(self) -> Any:
+        return {"scores": self.scores, "names": self.names}
+
+    def get(self, user_id: int) -> int:
+        return self.scores.get(str(user_id), 0)
+
+    def save(self, user_id: int, score: int, name: Optional[str] = None) -> bool:
+        uid = str(user_id)
+        if name and self.names.get(uid) != name:
+            self.names[uid] = name
+            self._mark_dirty()
+
+        current_high = self.scores.get(uid, 0)
+        if score <= current_high:
+            return False
+
+        if uid in self.scores:
+            self.ranking.pop(bisect.bisect_left(self.ranking, (-current_high, uid)))
+        bisect.insort(self.ranking, (-score, uid))
+        self.scores[uid] = score
+        self._mark_dirty()
         return True
-    return False
+
+    def top(self, n: int = 10) -> List[Tuple[str, int]]:
+        return [(uid, -neg_score) for neg_score, uid in self.ranking[:n]]
+
+    def rank(self, user_id: int) -> Optional[int]:
+        """Место игрока в рейтинге (с 1) или None, если рекорда нет"""
+        uid = str(user_id)
+        if uid not in self.scores:
+            return None
+        return bisect.bisect_left(self.ranking, (-self.scores[uid], uid)) + 1
+
+
+_HIGHSCORES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS highscores (
+    user_id INTEGER PRIMARY KEY,
+    score INTEGER NOT NULL,
+    name TEXT,
+    seq INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS highscores_seq ON highscores (seq);
+"""
+# seq - номер изменения по всей базе: запись идет под блокировкой BEGIN IMMEDIATE, поэтому номера
+# растут в порядке коммитов, и процесс забирает чужие рекорды запросом "seq больше моего последнего"
+_SQL_SAVE_SCORE = ("INSERT INTO highscores (user_id, score, name, seq) "
+                   "VALUES (?, ?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM highscores)) "
+                   "ON CONFLICT (user_id) DO UPDATE SET score = MAX(score, excluded.score), "
+                   "name = COALESCE(excluded.name, name), seq = excluded.seq")
+_SQL_SCORES_SINCE = "SELECT user_id, score, name, seq FROM highscores WHERE seq > ? ORDER BY seq"
+
+
+class SqliteHighScores(HighScores):
+    """Рекорды в общей базе SQLite. Рейтинг, как и в HighScores, живет в памяти, а фоновая
+    запись заодно забирает рекорды, поставленные в других процессах. В базе рекорд
+    только растет (MAX), так что процессы не затирают друг друга."""
+
+    def __init__(self, path: str = SQLITE_PATH, flush_delay: float = 2.0, refresh_interval: float = 5.0):
+        self.refresh_interval = refresh_interval
+        self.db = SqliteConnection(path, _HIGHSCORES_SCHEMA)
+        self._changed: set = set()
+        self._seq = 0
+        self._last_refresh = 0.0
+        super().__init__(path, flush_delay)
+
+    def _load(self):
+        self._apply(self.db.call(self._sync, [], 0))
+
+    def _apply(self, rows: List[Tuple[int, int, Optional[str], int]]):
+        for user_id, score, name, seq in rows:
+            uid = str(user_id)
+            if name:
+                self.names[uid] = name
+            current = self.scores.get(uid, 0)
+            if score > current:
+                if uid in self.scores:
+                    self.ranking.pop(bisect.bisect_left(self.ranking, (-current, uid)))
+                bisect.insort(self.ranking, (-score, uid))
+                self.scores[uid] = score
+            self._seq = max(self._seq, seq)
+        self._last_refresh = time.monotonic()
+
+    @staticmethod
+    def _sync(conn: sqlite3.Connection, rows: List[tuple], since: int) -> List[tuple]:
+        if rows:
+            _write_transaction(conn, [(_SQL_SAVE_SCORE, rows)])
+        return conn.execute(_SQL_SCORES_SINCE, (since,)).fetchall()
+
+    def _take_changed(self) -> List[tuple]:
+        rows = [(int(uid), self.scores.get(uid, 0), self.names.get(uid)) for uid in self._changed]
+        self._changed.clear()
+        return rows
+
+    def _refresh(self):
+        """Раз в refresh_interval подтягивает рекорды других процессов (в фоне, ответ не ждет)"""
+        if time.monotonic() - self._last_refresh < self.refresh_interval or self._dirty:
+            return
+        self._dirty = True
+        if self._flush_handle is None and self._flush_task is None:
+            self._start_flush()
+
+    async def _flush(self):
+        try:
+            while self._dirty:
+                self._dirty = False
+                rows = self._take_changed()
+                try:
+                    fetched = await self.db.run(self._sync, rows, self._seq)
+                except Exception as e:
+                    logging.error(f"Error saving high scores: {e}")
+                    self._changed.update(str(user_id) for user_id, _, _ in rows)
+                    break
+                self._apply(fetched)
+        finally:
+            self._flush_task = None
+
+    def _write(self):
+        self._dirty = False
+        self._apply(self.db.call(self._sync, self._take_changed(), self._seq))
+
+    def import_scores(self, scores: Dict[str, int], names: Dict[str, str]):
+        """Перенос рекордов из highscores.json (migrate_sqlite.py)"""
+        rows = [(int(uid), int(scores.get(uid, 0)), names.get(uid)) for uid in set(scores) | set(names)]
+        self._apply(self.db.call(self._sync, rows, self._seq))
+
+    def save(self, user_id: int, score: int, name: Optional[str] = None) -> bool:
+        uid = str(user_id)
+        before = (self.scores.get(uid), self.names.get(uid))
+        is_new_record = super().save(user_id, score, name)
+        if (self.scores.get(uid), self.names.get(uid)) != before:
+            self._changed.add(uid)
+        return is_new_record
+
+    def top(self, n: int = 10) -> List[Tuple[str, int]]:
+        self._refresh()
+        return super().top(n)
+
+    def rank(self, user_id: int) -> Optional[int]:
+        self._refresh()
+        return super().rank(user_id)
+
+    async def close(self):
+        await super().close()
+        self.db.close()
+
+
+def make_high_scores(path: str = HIGHSCORES_FILE) -> HighScores:
+    if STORAGE_MODE == "sqlite":
+        return SqliteHighScores(SQLITE_PATH)
+    return HighScores(path)
+
+
+# Создаются open_storages в процессе, который будет с ними работать
+HIGH_SCORES: Optional[HighScores] = None
+
+
+def get_high_score(user_id: int) -> int:
+    return HIGH_SCORES.get(user_id)
+
+
+def save_high_score(user_id: int, score: int, name: Optional[str] = None) -> bool:
+    return HIGH_SCORES.save(user_id, score, name)
 
 
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ (Нормализация) ---
@@ -138,57 +1184,1435 @@ def get_penultimate_valid_char(city_name: str) -> Optional[str]:
     return None
 
 
+# ТРАНСЛИТЕРАЦИЯ И ФОНЕТИЧЕСКИЕ КЛЮЧИ
+_CYR_TO_LAT = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e", "ж": "zh", "з": "z", "и": "i",
+    "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t",
+    "у": "u", "ф": "f", "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "shch", "ъ": "", "ы": "y", "ь": "",
+    "э": "e", "ю": "yu", "я": "ya",
+}
+_CYR_TO_LAT_TABLE = str.maketrans(_CYR_TO_LAT)
+
+# Свертки латиницы по порядку: разные системы транслитерации и близкие звуки сводятся к одному ключу.
+# Большие буквы - временные метки звуков, которых нет в латинице одной буквой
+_PHONETIC_FOLDS = [(re.compile(pattern), repl) for pattern, repl in (
+    (r"shch|sch|shh", "W"), (r"sh", "W"), (r"zh", "Z"), (r"tch", "Q"), (r"ch", "Q"), (r"kh", "h"),
+    (r"ts|tz|cz", "C"), (r"ph", "f"), (r"th", "t"), (r"x", "ks"), (r"w", "v"), (r"ck|q|c", "k"),
+    # й, ы, j - это i; гласная после согласного через i (Oryol, Kiyev) - как е/ё
+    (r"[yj]", "i"), (r"(?<=[^aeiou])io", "e"),
+    # йотированное е: Yekaterinburg = Ekaterinburg, Sarajevo = Saraevo, Perm'ye = Перме
+    (r"i(?=e)", ""),
+    # Двойные буквы: Tallinn = Таллин, Kassel = Кассель
+    (r"(.)\1+", r"\1"),
+)]
+
+# Обратная транслитерация латиницы для нечеткого поиска: сначала буквосочетания
+_LAT_TO_CYR = re.compile(r"shch|sch|zh|kh|ts|ch|sh|ya|yu|yo|ye|[a-z]")
+_LAT_TO_CYR_MAP = {
+    "shch": "щ", "sch": "щ", "zh": "ж", "kh": "х", "ts": "ц", "ch": "ч", "sh": "ш", "ya": "я", "yu": "ю",
+    "yo": "ё", "ye": "е", "a": "а", "b": "б", "c": "к", "d": "д", "e": "е", "f": "ф", "g": "г", "h": "х",
+    "i": "и", "j": "й", "k": "к", "l": "л", "m": "м", "n": "н", "o": "о", "p": "п", "q": "к", "r": "р",
+    "s": "с", "t": "т", "u": "у", "v": "в", "w": "в", "x": "кс", "y": "й", "z": "з",
+}
+
+
+def phonetic_key(norm: str) -> str:
+    """Ключ для поиска по звучанию: кириллица транслитерируется, затем свертки _PHONETIC_FOLDS.
+    Moskva, Москва; Oryol, Орёл, Орел; Tallinn, Таллин дают одинаковые ключи."""
+    key = norm.translate(_CYR_TO_LAT_TABLE)
+    for pattern, repl in _PHONETIC_FOLDS:
+        key = pattern.sub(repl, key)
+    return key
+
+
+def latin_to_cyrillic(norm: str) -> str:
+    return _LAT_TO_CYR.sub(lambda m: _LAT_TO_CYR_MAP[m.group(0)], norm)
+
+
 # ЗАГРУЗКА ГОРОДОВ
-RAW_CITIES = []
-if os.path.exists("cities.txt"):
-    with open("cities.txt", "r", encoding="utf-8") as f:
-        RAW_CITIES = [city.strip() for city in f if city.strip()]
-else:
-    logging.warning("Файл cities.txt не найден! Бот не будет знать городов.")
-
-CITIES_MAP = {normalize_city(c): c for c in RAW_CITIES}
-CITIES_KEYS = list(CITIES_MAP.keys())
-
-TOP_CITIES_NORM = set()
-if os.path.exists("top_cities.txt"):
-    with open("top_cities.txt", "r", encoding="utf-8") as f:
-        for line in f:
-            if line.strip():
-                TOP_CITIES_NORM.add(normalize_city(line.strip()))
-else:
-    logging.warning("Файл top_cities.txt не найден. Приоритезация работать не будет.")
-
-
-def find_best_match(user_input: str, threshold: int = 72):
-    user_norm = normalize_city(user_input)
-    if user_norm in CITIES_MAP:
-        return user_norm, CITIES_MAP[user_norm]
+def read_raw_cities(path: str = "cities.txt") -> List[str]:
+    if not os.path.exists(path):
+        logging.warning("Файл cities.txt не найден! Бот не будет знать городов.")
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [city.strip() for city in f if city.strip()]
+
+
+def read_top_cities(path: str = "top_cities.txt") -> List[str]:
+    if not os.path.exists(path):
+        logging.warning("Файл top_cities.txt не найден. Приоритезация работать не будет.")
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+# ИНДЕКС ПО ПЕРВОЙ БУКВЕ
+def build_letter_index(cities_map: Dict[str, str], top_norm: set):
+    """Раскладывает города по первой букве: отдельно топовые и все остальные"""
+    top_by_letter: Dict[str, List[str]] = {}
+    other_by_letter: Dict[str, List[str]] = {}
+    for norm in cities_map:
+        if not norm:
+            continue
+        bucket = top_by_letter if norm in top_norm else other_by_letter
+        bucket.setdefault(norm[0], []).append(norm)
+    return top_by_letter, other_by_letter
+
+
+# --- СНИМОК КАТАЛОГА ГОРОДОВ ---
+# Кэш уже посчитанного по cities.txt и top_cities.txt: нормализованные города, исходные названия,
+# последние/предпоследние буквы, топ, корзины по буквам и фонетические ключи. Лежит в pickle из
+# встроенных типов и пересобирается, если поменялись исходники (сравниваем sha256).
+# Экономит только время запуска: индексы по городам каждый процесс все равно держит у себя.
+CATALOG_FORMAT = 3
+
+
+def catalog_source_hash(cities_path: str = "cities.txt", top_path: str = "top_cities.txt") -> bytes:
+    digest = hashlib.sha256(str(CATALOG_FORMAT).encode())
+    # Фонетические ключи лежат в снимке, поэтому правила транслитерации - тоже часть исходников
+    digest.update(repr((sorted(_CYR_TO_LAT.items()), [(p.pattern, r) for p, r in _PHONETIC_FOLDS])).encode())
+    for path in (cities_path, top_path):
+        digest.update(b"\0")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.digest()
+
+
+def compile_catalog(raw_cities: List[str], top_lines: List[str], source_hash: bytes) -> Dict[str, Any]:
+    cities_map = {normalize_city(c): c for c in raw_cities}
+    top_norm = {normalize_city(line) for line in top_lines}
+    top_by_letter, other_by_letter = build_letter_index(cities_map, top_norm)
+    return {
+        "format": CATALOG_FORMAT,
+        "source_hash": source_hash,
+        "cities_map": cities_map,
+        "top_norm": top_norm,
+        "last": [get_last_valid_char(norm) if norm else "" for norm in cities_map],
+        "penult": [get_penultimate_valid_char(norm) for norm in cities_map],
+        "top_by_letter": top_by_letter,
+        "other_by_letter": other_by_letter,
+        "phonetic": [phonetic_key(norm) for norm in cities_map],
+    }
+
+
+class CatalogSnapshot:
+    """Скомпилированный каталог; списки last, penult и phonetic идут в порядке keys"""
+
+    def __init__(self, data: Dict[str, Any]):
+        if data.get("format") != CATALOG_FORMAT:
+            raise ValueError("unsupported catalog snapshot format")
+        self.source_hash: bytes = data["source_hash"]
+        self.cities_map: Dict[str, str] = data["cities_map"]
+        self.keys: List[str] = list(self.cities_map)
+        self.top_norm: set = data["top_norm"]
+        self.top_by_letter: Dict[str, List[str]] = data["top_by_letter"]
+        self.other_by_letter: Dict[str, List[str]] = data["other_by_letter"]
+        self.phonetic_keys: List[str] = data["phonetic"]
+        self._last: List[str] = data["last"]
+        self._penult: List[Optional[str]] = data["penult"]
+        if not (len(self._last) == len(self._penult) == len(self.phonetic_keys) == len(self.keys)):
+            raise ValueError("corrupted catalog snapshot")
+
+    def letters(self, pos: int) -> Tuple[str, Optional[str]]:
+        """Последняя и предпоследняя игровые буквы города"""
+        return self._last[pos], self._penult[pos]
+
+    def keys_by_letter(self) -> Dict[str, List[str]]:
+        """Все города на букву (и топовые, и остальные) в порядке каталога, как keys"""
+        by_letter: Dict[str, List[str]] = {}
+        for norm in self.keys:
+            if norm:
+                by_letter.setdefault(norm[0], []).append(norm)
+        return by_letter
+
+
+def write_catalog_snapshot(path: str = CATALOG_FILE) -> Dict[str, Any]:
+    """Собирает снимок из cities.txt и top_cities.txt и атомарно записывает его"""
+    data = compile_catalog(read_raw_cities(), read_top_cities(), catalog_source_hash())
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    return data
+
+
+def load_catalog(path: str = CATALOG_FILE) -> CatalogSnapshot:
+    source_hash = catalog_source_hash()
+    if os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+            if isinstance(data, dict) and data.get("format") == CATALOG_FORMAT \
+                    and data.get("source_hash") == source_hash:
+                return CatalogSnapshot(data)
+            logging.info("Снимок каталога устарел, пересобираем")
+        except Exception as e:
+            logging.error(f"Error loading catalog snapshot: {e}")
+
+    try:
+        data = write_catalog_snapshot(path)
+    except Exception as e:
+        logging.error(f"Error saving catalog snapshot: {e}")
+        data = compile_catalog(read_raw_cities(), read_top_cities(), source_hash)
+    return CatalogSnapshot(data)
+
+
+def city_letters(norm: str) -> Tuple[str, Optional[str]]:
+    """Последняя и предпоследняя буквы города из каталога (посчитаны при сборке снимка)"""
+    return CATALOG.letters(CITY_POS[norm])
+
+
+# МАТРИЦА ПЕРЕХОДОВ "ПЕРВАЯ БУКВА -> ПОСЛЕДНЯЯ БУКВА"
+def build_transition_index(top_by_letter, other_by_letter, letters=city_letters):
+    """transitions[s][e] = ([топовые], [остальные]) - города на s, после которых ходят на e"""
+    transitions: Dict[str, Dict[str, Tuple[List[str], List[str]]]] = {}
+    for part, buckets in enumerate((top_by_letter, other_by_letter)):
+        for start, bucket in buckets.items():
+            for norm in bucket:
+                end = letters(norm)[0]
+                transitions.setdefault(start, {}).setdefault(end, ([], []))[part].append(norm)
+    counts = {start: {end: len(top) + len(other) for end, (top, other) in ends.items()}
+              for start, ends in transitions.items()}
+    return transitions, counts
+
+
+# ЦЕЛОЧИСЛЕННЫЕ ID ГОРОДОВ
+def city_ids_path() -> str:
+    return CITY_IDS_FILE or STORAGE_PATH + ".ids"
+
+
+def _read_city_ids(path: str) -> List[str]:
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_SH)
+        return [line.rstrip("\n") for line in f]
+
+
+def load_city_ids(path: str, keys: List[str], seed: Optional[str] = CITY_IDS_SEED) -> List[str]:
+    """Реестр id: номер строки в файле = id города. Новые города дописываются в конец,
+    удаленные сохраняют свой id, поэтому сохраненные игры не ломаются при правке cities.txt.
+    Новый реестр начинается с копии seed; пока новых городов нет, файл не создается.
+    Дописывание идет под блокировкой файла: воркеры перезагружают каталог одновременно."""
+    registry = _read_city_ids(path) or (_read_city_ids(seed) if seed else [])
+    known = set(registry)
+    if all(key in known for key in keys):
+        return registry
+
+    registry = []
+    new_keys: List[str] = []
+    try:
+        with open(path, "a+", encoding="utf-8") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)  # снимается при закрытии файла
+            if f.tell() == 0 and seed:
+                f.writelines(key + "\n" for key in _read_city_ids(seed))
+            f.seek(0)
+            registry = [line.rstrip("\n") for line in f]
+            known = set(registry)
+            new_keys = [key for key in keys if key not in known]
+            f.writelines(key + "\n" for key in new_keys)
+    except Exception as e:
+        logging.error(f"Error saving city ids: {e}")
+        if not registry:
+            registry = _read_city_ids(path) or (_read_city_ids(seed) if seed else [])
+        known = set(registry)
+        new_keys = [key for key in keys if key not in known]
+    registry.extend(new_keys)
+    return registry
+
+
+# --- ИСПОЛЬЗОВАННЫЕ ГОРОДА И СЧЕТЧИКИ В ИГРЕ ---
+def new_game_data(difficulty: Optional[str] = None) -> Dict[str, Any]:
+    return {"used_ids": bytearray((len(CITY_BY_ID) + 7) // 8), "letters_used": {}, "transitions_used": {},
+            "catalog": CATALOG_TAG, "last_letter": None, "penult_letter": None, "score": 0,
+            "difficulty": difficulty or "normal"}
+
+
+def get_used_ids(data: Dict[str, Any]) -> bytearray:
+    """Битовая маска использованных городов по id.
+    Старые сессии со списком used_cities переводятся в маску при первом обращении."""
+    used_ids = data.get("used_ids")
+    if used_ids is None:
+        used_ids = bytearray((len(CITY_BY_ID) + 7) // 8)
+        for norm in data.pop("used_cities", []):
+            city_id = CITY_IDS.get(norm)
+            if city_id is not None:
+                used_ids[city_id >> 3] |= 1 << (city_id & 7)
+        data["used_ids"] = used_ids
+    return used_ids
+
+
+def is_city_used(data: Dict[str, Any], norm: str) -> bool:
+    city_id = CITY_IDS.get(norm)
+    if city_id is None:
+        return False
+    used_ids = get_used_ids(data)
+    return (city_id >> 3) < len(used_ids) and bool(used_ids[city_id >> 3] & (1 << (city_id & 7)))
+
+
+def iter_used_cities(data: Dict[str, Any]):
+    used_ids = get_used_ids(data)
+    for byte_idx, byte in enumerate(used_ids):
+        if not byte:
+            continue
+        for bit in range(8):
+            if byte & (1 << bit):
+                yield CITY_BY_ID[(byte_idx << 3) | bit]
+
+
+def _sync_counters(data: Dict[str, Any]):
+    """Счетчики по буквам и переходам считаются по конкретной версии каталога (тег в data["catalog"]).
+    Для старых сессий без счетчиков и для игр, начатых до перезагрузки каталога, пересчитываем
+    их по использованным городам: id городов постоянные, а удаленные из каталога не учитываются."""
+    if (data.get("catalog") == CATALOG_TAG and data.get("letters_used") is not None
+            and data.get("transitions_used") is not None):
+        return
+    letters_used: Dict[str, List[int]] = {}
+    transitions_used: Dict[str, Dict[str, int]] = {}
+    for norm in iter_used_cities(data):
+        if norm in CITY_POS:
+            _count_used(letters_used, norm)
+            _count_transition(transitions_used, norm)
+    data.update(letters_used=letters_used, transitions_used=transitions_used, catalog=CATALOG_TAG)
+
+
+def get_letters_used(data: Dict[str, Any]) -> Dict[str, List[int]]:
+    """Счетчики использованных городов по буквам: {буква: [топовых, остальных]}"""
+    _sync_counters(data)
+    return data["letters_used"]
+
+
+def _count_used(letters_used: Dict[str, List[int]], norm: str):
+    if not norm:
+        return
+    counters = letters_used.setdefault(norm[0], [0, 0])
+    counters[0 if norm in TOP_CITIES_NORM else 1] += 1
+
+
+def get_transitions_used(data: Dict[str, Any]) -> Dict[str, Dict[str, int]]:
+    """Сколько городов с переходом s -> e уже названо в игре: {s: {e: n}}"""
+    _sync_counters(data)
+    return data["transitions_used"]
+
+
+def _count_transition(transitions_used: Dict[str, Dict[str, int]], norm: str):
+    if not norm:
+        return
+    ends = transitions_used.setdefault(norm[0], {})
+    end = city_letters(norm)[0]
+    ends[end] = ends.get(end, 0) + 1
+
+
+def mark_city_used(data: Dict[str, Any], norm: str):
+    """Отмечает город использованным и обновляет счетчики по буквам и переходам"""
+    letters_used = get_letters_used(data)
+    transitions_used = get_transitions_used(data)
+    used_ids = get_used_ids(data)
+    city_id = CITY_IDS[norm]
+    if (city_id >> 3) >= len(used_ids):
+        used_ids.extend(bytearray((city_id >> 3) + 1 - len(used_ids)))
+    used_ids[city_id >> 3] |= 1 << (city_id & 7)
+    _count_used(letters_used, norm)
+    _count_transition(transitions_used, norm)
+
+
+def remaining_on_letter(data: Dict[str, Any], letter: str) -> Tuple[int, int]:
+    """Сколько городов на букву еще не названо: (топовых, остальных)"""
+    top_used, other_used = get_letters_used(data).get(letter, (0, 0))
+    return (len(TOP_BY_LETTER.get(letter, ())) - top_used,
+            len(OTHER_BY_LETTER.get(letter, ())) - other_used)
+
 
-    result = process.extractOne(user_norm, CITIES_KEYS, scorer=fuzz.ratio)
+def _pick_unused(data: Dict[str, Any], bucket: List[str], remaining: int) -> Optional[str]:
+    if remaining <= 0:
+        return None
+    # Пока свободных много, случайная выборка почти всегда попадает с первой попытки
+    for _ in range(8):
+        norm = random.choice(bucket)
+        if not is_city_used(data, norm):
+            return norm
+    free = [norm for norm in bucket if not is_city_used(data, norm)]
+    return random.choice(free) if free else None
+
+
+def pick_city(data: Dict[str, Any], letter: str, prefer_top: bool = True) -> Optional[str]:
+    """Случайный неиспользованный город на букву.
+    prefer_top=True: сначала топовые, затем остальные; иначе равновероятно среди всех."""
+    top_left, other_left = remaining_on_letter(data, letter)
+    if top_left + other_left <= 0:
+        return None
+
+    top_bucket = TOP_BY_LETTER.get(letter, [])
+    other_bucket = OTHER_BY_LETTER.get(letter, [])
+
+    if prefer_top:
+        use_top = top_left > 0
+    else:
+        use_top = random.randrange(top_left + other_left) < top_left
+
+    if use_top:
+        return _pick_unused(data, top_bucket, top_left)
+    return _pick_unused(data, other_bucket, other_left)
+
+
+def remaining_transitions(data: Dict[str, Any], letter: str) -> Dict[str, int]:
+    """Сколько неназванных городов на букву заканчивается на каждую букву"""
+    used = get_transitions_used(data).get(letter, {})
+    return {end: total - used.get(end, 0) for end, total in TRANSITION_COUNTS.get(letter, {}).items()}
+
+
+def pick_city_hard(data: Dict[str, Any], letter: str) -> Optional[str]:
+    """Ход "сложного" бота: город, после которого у игрока меньше всего вариантов.
+    Перебирает только буквы алфавита, а не весь словарь."""
+    best_ends: List[str] = []
+    best_options = None
+    for end, left in remaining_transitions(data, letter).items():
+        if left <= 0:
+            continue
+        # Если конец совпадает с началом, наш ход сам уберет один вариант у игрока
+        options = sum(remaining_on_letter(data, end)) - (1 if end == letter else 0)
+        if best_options is None or options < best_options:
+            best_ends, best_options = [end], options
+        elif options == best_options:
+            best_ends.append(end)
+    if not best_ends:
+        return None
+
+    top, other = TRANSITIONS[letter][random.choice(best_ends)]
+    for bucket in (top, other):
+        free = [norm for norm in bucket if not is_city_used(data, norm)]
+        if free:
+            return random.choice(free)
+    return None
+
+
+# --- ПОИСК ПО ЗВУЧАНИЮ ---
+def build_phonetic_index(keys: List[str], phonetic_keys: List[str]) -> Dict[str, List[str]]:
+    """Фонетический ключ -> нормализованные названия с таким ключом (в порядке каталога)"""
+    index: Dict[str, List[str]] = {}
+    for norm, key in zip(keys, phonetic_keys):
+        index.setdefault(key, []).append(norm)
+    return index
+
+
+def phonetic_match(user_norm: str, letter: Optional[str] = None, query: Optional[str] = None) -> Optional[str]:
+    """Город с тем же фонетическим ключом. Из нескольких (Таллин и Талин) берем ближайший
+    по fuzz.ratio к query (ввод в кириллице), предпочитая города на нужную букву"""
+    found = PHONETIC_INDEX.get(phonetic_key(user_norm))
+    if not found:
+        return None
+    if len(found) == 1:
+        return found[0]
+    if letter:
+        found = [norm for norm in found if norm.startswith(letter)] or found
+    query = query or user_norm
+    # max оставляет первый из равных, то есть при равенстве - порядок каталога
+    return max(found, key=lambda norm: fuzz.ratio(query, norm))
+
+
+# --- ИНДЕКС ДЛЯ НЕЧЕТКОГО ПОИСКА ---
+class FuzzyIndex:
+    """Отсев кандидатов для fuzz.ratio по длине строки.
+
+    fuzz.ratio = 200 * LCS / (a + b), где a и b - длины строк, а LCS <= min(a, b).
+    Поэтому для запроса длины a до порога могут дотянуться только ключи из
+    узкого диапазона длин. Списки таких ключей строятся один раз на длину запроса
+    и сохраняют исходный порядок, так что при равных баллах выигрывает тот же
+    город, что и при полном переборе process.extractOne.
+    """
+
+    def __init__(self, keys: List[str]):
+        self.keys = keys
+        self._by_query_length: Dict[Tuple[int, int], List[str]] = {}
+
+    def candidates(self, query: str, threshold: int) -> List[str]:
+        """Ключи, которые по длине могут набрать threshold (в исходном порядке)"""
+        a = len(query)
+        if not a:
+            return []
+        cached = self._by_query_length.get((a, threshold))
+        if cached is None:
+            # Итоговый балл округляется, поэтому границу берем с запасом в полбалла
+            cutoff = (threshold - 0.5) / 200 - 1e-9
+            cached = [key for key in self.keys if min(a, len(key)) >= cutoff * (a + len(key))]
+            self._by_query_length[(a, threshold)] = cached
+        return cached
+
+
+@lru_cache(maxsize=4096)
+def _fuzzy_match(user_norm: str, threshold: int, letter: Optional[str]) -> Optional[str]:
+    index = FUZZY_BY_LETTER.get(letter) if letter else FUZZY_INDEX
+    if index is None:
+        return None
+    candidates = index.candidates(user_norm, threshold)
+    if not candidates:
+        return None
+    # Ключи уже нормализованы, поэтому processor не нужен, а score_cutoff
+    # позволяет rapidfuzz отбрасывать слабых кандидатов без полного подсчета
+    result = process.extractOne(user_norm, candidates, scorer=fuzz.ratio, processor=None,
+                                score_cutoff=threshold - 0.5)
     if result:
         best_match, score = result
         if score >= threshold:
+            return best_match
+    return None
+
+
+def find_best_match(user_input: str, threshold: int = 72, letter: Optional[str] = None):
+    """Точное совпадение, затем ближайший город по fuzz.ratio, затем совпадение по звучанию
+    (ё/е, двойные буквы). Если задана буква, сначала ищем среди городов на нее, потом везде.
+    Латиница ищется только по звучанию: после транслитерации fuzz.ratio находит город почти
+    в любом слове ("hello" - Ахелой), поэтому нечеткий поиск для нее не используется."""
+    user_norm = normalize_city(user_input)
+    if user_norm in CITIES_MAP:
+        METRICS.inc("cities_match_total", result="exact")
+        return user_norm, CITIES_MAP[user_norm]
+
+    is_latin = re.search(r"[a-z]", user_norm) is not None
+    if not is_latin:
+        start = time.perf_counter()
+        best_match = None
+        if letter:
+            best_match = _fuzzy_match(user_norm, threshold, letter)
+        if best_match is None:
+            best_match = _fuzzy_match(user_norm, threshold, None)
+        METRICS.observe("cities_fuzzy_match_seconds", time.perf_counter() - start)
+        if best_match is not None:
+            METRICS.inc("cities_match_total", result="fuzzy")
             return best_match, CITIES_MAP[best_match]
+
+    found = phonetic_match(user_norm, letter, latin_to_cyrillic(user_norm) if is_latin else user_norm)
+    if found is not None:
+        METRICS.inc("cities_match_total", result="phonetic")
+        return found, CITIES_MAP[found]
+    METRICS.inc("cities_match_total", result="miss")
     return None
 
 
+# --- ВЕРСИИ КАТАЛОГА И ГОРЯЧАЯ ПЕРЕЗАГРУЗКА ---
+class CityCatalog:
+    """Одна версия каталога: снимок и все построенные по нему индексы.
+
+    Собирается целиком (в отдельном потоке при перезагрузке) и только потом
+    подставляется в глобальные переменные модуля через install_catalog.
+    """
+
+    def __init__(self, version: int, snapshot: CatalogSnapshot):
+        self.version = version
+        self.snapshot = snapshot
+        # Тег версии в данных игры: совпадает у процессов и перезапусков с одинаковыми исходниками
+        self.tag = snapshot.source_hash[:8].hex()
+        self.keys = snapshot.keys
+        self.city_pos = {norm: pos for pos, norm in enumerate(self.keys)}
+        self.cities_map = snapshot.cities_map
+        self.top_norm = snapshot.top_norm
+        self.top_by_letter, self.other_by_letter = snapshot.top_by_letter, snapshot.other_by_letter
+        self.transitions, self.transition_counts = build_transition_index(
+            self.top_by_letter, self.other_by_letter, lambda norm: snapshot.letters(self.city_pos[norm]))
+        self.city_by_id = load_city_ids(city_ids_path(), self.keys)
+        self.city_ids = {norm: city_id for city_id, norm in enumerate(self.city_by_id)}
+        # Фонетические ключи посчитаны при сборке снимка каталога, здесь только словарь
+        self.phonetic_index = build_phonetic_index(self.keys, snapshot.phonetic_keys)
+        self.fuzzy_index = FuzzyIndex(self.keys)
+        self.fuzzy_by_letter = {letter: FuzzyIndex(keys) for letter, keys in snapshot.keys_by_letter().items()}
+
+
+def install_catalog(catalog: CityCatalog):
+    """Подменяет текущую версию каталога. Все глобальные переменные меняются без await между ними,
+    поэтому обработчик между своими await видит либо старую версию целиком, либо новую."""
+    global CITY_CATALOG, CATALOG, CATALOG_TAG, CITIES_KEYS, CITIES_MAP, CITY_POS, TOP_CITIES_NORM, \
+        TOP_BY_LETTER, OTHER_BY_LETTER, TRANSITIONS, TRANSITION_COUNTS, CITY_BY_ID, CITY_IDS, \
+        PHONETIC_INDEX, FUZZY_INDEX, FUZZY_BY_LETTER
+    CITY_CATALOG = catalog
+    CATALOG = catalog.snapshot
+    CATALOG_TAG = catalog.tag
+    CITIES_KEYS = catalog.keys
+    CITIES_MAP = catalog.cities_map
+    CITY_POS = catalog.city_pos
+    TOP_CITIES_NORM = catalog.top_norm
+    TOP_BY_LETTER, OTHER_BY_LETTER = catalog.top_by_letter, catalog.other_by_letter
+    TRANSITIONS, TRANSITION_COUNTS = catalog.transitions, catalog.transition_counts
+    CITY_BY_ID, CITY_IDS = catalog.city_by_id, catalog.city_ids
+    PHONETIC_INDEX = catalog.phonetic_index
+    FUZZY_INDEX, FUZZY_BY_LETTER = catalog.fuzzy_index, catalog.fuzzy_by_letter
+    # В кэше могут быть города, которых в новой версии уже нет
+    _fuzzy_match.cache_clear()
+
+
+install_catalog(CityCatalog(1, load_catalog()))
+_catalog_lock = asyncio.Lock()
+
+
+async def reload_catalog(force: bool = False) -> bool:
+    """Пересобирает каталог в отдельном потоке и подменяет его, если исходники поменялись
+    (или force). Возвращает True, если версия сменилась."""
+    async with _catalog_lock:
+        source_hash = await asyncio.to_thread(catalog_source_hash)
+        if source_hash == CATALOG.source_hash and not force:
+            return False
+        start = time.perf_counter()
+        try:
+            catalog = await asyncio.to_thread(lambda: CityCatalog(CITY_CATALOG.version + 1, load_catalog()))
+        except Exception:
+            METRICS.inc("cities_catalog_reloads_total", result="error")
+            raise
+        install_catalog(catalog)
+    METRICS.inc("cities_catalog_reloads_total", result="ok")
+    logging.info(f"Каталог перезагружен: версия {catalog.version}, городов {len(catalog.keys)}, "
+                 f"{time.perf_counter() - start:.2f} с")
+    return True
+
+
+def _catalog_sources_stat() -> Tuple[Optional[Tuple[int, int]], ...]:
+    stats = []
+    for path in ("cities.txt", "top_cities.txt"):
+        try:
+            st = os.stat(path)
+            stats.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            stats.append(None)
+    return tuple(stats)
+
+
+async def watch_catalog(interval: float):
+    """Следит за исходниками каталога и перезагружает его. Перезагрузка начинается, когда
+    файлы не менялись целый интервал, чтобы не собрать каталог из недописанного файла."""
+    seen = _catalog_sources_stat()
+    pending = False
+    while True:
+        await asyncio.sleep(interval)
+        current = _catalog_sources_stat()
+        if current != seen:
+            seen = current
+            pending = True
+            continue
+        if pending:
+            pending = False
+            try:
+                await reload_catalog()
+            except Exception as e:
+                logging.error(f"Error reloading catalog: {e}")
+
+
+# КЭШ ФАКТОВ О ГОРОДАХ
+class CityFactsCache(JsonWriteBehind):
+    """Справки ИИ по отдельным городам: LRU с ограничением размера и сроком жизни.
+
+    Файл - журнал в формате JSON lines: новая справка дописывается строкой [город, время, текст],
+    из нескольких строк одного города главнее последняя. Когда строк становится вдвое больше,
+    чем справок в памяти, файл переписывается целиком (сериализация - в потоке).
+    Первой строкой может быть старый формат - весь кэш одним JSON-объектом."""
+
+    def __init__(self, path: str = FACTS_CACHE_FILE, ttl: float = FACTS_TTL, max_items: int = FACTS_MAX_ITEMS):
+        super().__init__(path)
+        self.ttl = ttl
+        self.max_items = max_items
+        # нормализованное название -> [время записи, текст], от старых к свежим
+        self.items: "OrderedDict[str, List[Any]]" = OrderedDict()
+        self._changed: set = set()  # новые справки, которых еще нет в файле
+        self._lines = 0
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        raw: Dict[str, List[Any]] = {}
+        good_offset = 0
+        rewrite = False
+        try:
+            with open(self.path, "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # недописанная строка после падения
+                    good_offset += len(line)
+                    self._lines += 1
+                    # Старый формат (объект целиком) и строка без перевода строки - переписываем файл
+                    rewrite = rewrite or isinstance(record, dict) or not line.endswith(b"\n")
+                    if isinstance(record, dict):
+                        raw.update(record)
+                    else:
+                        norm, ts, text = record
+                        raw[norm] = [ts, text]
+            if good_offset != os.path.getsize(self.path):
+                with open(self.path, "r+b") as f:
+                    f.truncate(good_offset)
+        except Exception as e:
+            logging.error(f"Error loading {self.path}: {e}")
+        now = time.time()
+        for norm, (ts, text) in sorted(raw.items(), key=lambda item: item[1][0]):
+            if now - ts < self.ttl:
+                self.items[norm] = [ts, text]
+        self._evict()
+        if rewrite:
+            self._rewrite(self._dump())
+
+    def _dump(self) -> Any:
+        # Копия: файл из нее собирается в потоке, пока обработчики меняют self.items
+        return dict(self.items)
+
+    def _compact_due(self) -> bool:
+        return self._lines > 2 * len(self.items) + 1000
+
+    def _take_new(self) -> Tuple[str, int]:
+        lines = [json.dumps([norm, *self.items[norm]], ensure_ascii=False) + "\n"
+                 for norm in self._changed if norm in self.items]
+        self._changed.clear()
+        return "".join(lines), len(lines)
+
+    async def _flush(self):
+        try:
+            while self._dirty:
+                self._dirty = False
+                if self._compact_due():
+                    self._changed.clear()
+                    await asyncio.to_thread(self._rewrite, self._dump())
+                    continue
+                text, count = self._take_new()
+                if count:
+                    await asyncio.to_thread(self._append_lines, text, count)
+        finally:
+            self._flush_task = None
+
+    def _write(self):
+        self._dirty = False
+        if self._compact_due():
+            self._changed.clear()
+            self._rewrite(self._dump())
+            return
+        text, count = self._take_new()
+        if count:
+            self._append_lines(text, count)
+
+    def _append_lines(self, text: str, count: int):
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(text)
+            self._lines += count
+        except Exception as e:
+            logging.error(f"Error saving {self.path}: {e}")
+
+    def _rewrite(self, snapshot: Dict[str, List[Any]]):
+        self._write_text("".join(json.dumps([norm, ts, text], ensure_ascii=False) + "\n"
+                                 for norm, (ts, text) in snapshot.items()))
+        self._lines = len(snapshot)
+
+    def _evict(self):
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+    def get(self, city: str) -> Optional[str]:
+        norm = normalize_city(city)
+        entry = self.items.get(norm)
+        if entry is None:
+            return None
+        if time.time() - entry[0] >= self.ttl:
+            del self.items[norm]
+            self._mark_dirty()
+            return None
+        self.items.move_to_end(norm)
+        return entry[1]
+
+    def put(self, city: str, text: str):
+        norm = normalize_city(city)
+        self.items[norm] = [time.time(), text]
+        self.items.move_to_end(norm)
+        self._changed.add(norm)
+        self._evict()
+        self._mark_dirty()
+
+
+_FACTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS city_facts (
+    norm TEXT PRIMARY KEY,
+    ts REAL NOT NULL,
+    text TEXT NOT NULL,
+    seq INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS city_facts_seq ON city_facts (seq);
+CREATE INDEX IF NOT EXISTS city_facts_ts ON city_facts (ts);
+"""
+# seq - как у рекордов: процесс забирает чужие справки запросом "seq больше моего последнего"
+_SQL_SAVE_FACTS = ("INSERT INTO city_facts (norm, ts, text, seq) "
+                   "VALUES (?, ?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM city_facts)) "
+                   "ON CONFLICT (norm) DO UPDATE SET ts = excluded.ts, text = excluded.text, seq = excluded.seq "
+                   "WHERE excluded.ts > city_facts.ts")
+_SQL_EXPIRE_FACTS = "DELETE FROM city_facts WHERE ts < ?"
+_SQL_FACTS_SINCE = "SELECT norm, ts, text, seq FROM city_facts WHERE seq > ? AND ts >= ? ORDER BY seq"
+
+
+class SqliteFactsCache(CityFactsCache):
+    """Кэш справок в общей базе SQLite, чтобы воркеры не спрашивали ИИ про один город каждый сам.
+    Как и в SqliteHighScores, справки живут в памяти, а фоновая запись отправляет новые
+    и забирает те, что получили другие процессы (не реже refresh_interval, если кэш читают)."""
+
+    def __init__(self, path: str = SQLITE_PATH, ttl: float = FACTS_TTL, max_items: int = FACTS_MAX_ITEMS,
+                 refresh_interval: float = 5.0):
+        self.refresh_interval = refresh_interval
+        self.db = SqliteConnection(path, _FACTS_SCHEMA)
+        self._seq = 0
+        self._last_refresh = 0.0
+        super().__init__(path, ttl, max_items)
+
+    def _load(self):
+        self._apply(self.db.call(self._sync, [], 0, time.time() - self.ttl))
+
+    def _apply(self, rows: List[Tuple[str, float, str, int]]):
+        for norm, ts, text, seq in rows:
+            entry = self.items.get(norm)
+            if entry is None or entry[0] < ts:
+                self.items[norm] = [ts, text]
+                self.items.move_to_end(norm)
+            self._seq = max(self._seq, seq)
+        self._evict()
+        self._last_refresh = time.monotonic()
+
+    @staticmethod
+    def _sync(conn: sqlite3.Connection, rows: List[tuple], since: int, oldest: float) -> List[tuple]:
+        _write_transaction(conn, [(_SQL_SAVE_FACTS, rows), (_SQL_EXPIRE_FACTS, [(oldest,)])])
+        return conn.execute(_SQL_FACTS_SINCE, (since, oldest)).fetchall()
+
+    def _take_changed(self) -> List[tuple]:
+        rows = [(norm, *self.items[norm]) for norm in self._changed if norm in self.items]
+        self._changed.clear()
+        return rows
+
+    async def _flush(self):
+        try:
+            while self._dirty:
+                self._dirty = False
+                rows = self._take_changed()
+                try:
+                    fetched = await self.db.run(self._sync, rows, self._seq, time.time() - self.ttl)
+                except Exception as e:
+                    logging.error(f"Error saving city facts: {e}")
+                    self._changed.update(norm for norm, _, _ in rows)
+                    break
+                self._apply(fetched)
+        finally:
+            self._flush_task = None
+
+    def _write(self):
+        self._dirty = False
+        self._apply(self.db.call(self._sync, self._take_changed(), self._seq, time.time() - self.ttl))
+
+    def get(self, city: str) -> Optional[str]:
+        text = super().get(city)
+        if text is None and time.monotonic() - self._last_refresh >= self.refresh_interval and not self._dirty:
+            # Промах: возможно, справку уже получил другой воркер - подтягиваем в фоне
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                return None
+            self._dirty = True
+            if self._flush_handle is None and self._flush_task is None:
+                self._start_flush()
+        return text
+
+    async def close(self):
+        await super().close()
+        self.db.close()
+
+
+def make_facts_cache(path: str = FACTS_CACHE_FILE) -> CityFactsCache:
+    if STORAGE_MODE == "sqlite":
+        return SqliteFactsCache(SQLITE_PATH)
+    return CityFactsCache(path)
+
+
+CITY_FACTS: Optional[CityFactsCache] = None  # см. open_storages
+_gemini_semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+
 # ФУНКЦИЯ ЗАПРОСА К AI
-async def get_cities_info(user_city: str, bot_city: str) -> str:
+async def _generate(prompt: str, progress) -> str:
+    if not FACTS_STREAMING:
+        response = await model.generate_content_async(prompt)
+        return response.text
+    start = time.perf_counter()
+    response = await model.generate_content_async(prompt, stream=True)
+    text = ""
+    async for chunk in response:
+        if not text:
+            METRICS.observe("cities_gemini_first_chunk_seconds", time.perf_counter() - start)
+        text += chunk.text
+        progress(text)
+    return text
+
+
+async def _fetch_city_info(city: str, progress=lambda text: None) -> Optional[str]:
+    """Справка ИИ о городе; progress(text) вызывается с накопленным текстом на каждый кусок ответа"""
     prompt = (
-        f"Напиши интересную справку о двух городах: {user_city} и {bot_city}. "
+        f"Напиши интересную справку о городе {city}. "
         f"Формат ответа должен быть строго таким:\n\n"
-        f"<b>🌍 Подробнее о городе {user_city}:</b>\n\n"
-        f"(Тут 3-4 предложения: страна, население, интересный факт)\n\n"
-        f"<b>🌍 Подробнее о городе {bot_city}:</b>\n\n"
+        f"<b>🌍 Подробнее о городе {city}:</b>\n\n"
         f"(Тут 3-4 предложения: страна, население, интересный факт)\n\n"
-        f"В начале каждого факта - эмодзи-флаг страны, к которой принадлежит город. Пиши по-русски, используй эмодзи, будь краток."
+        f"В начале факта - эмодзи-флаг страны, к которой принадлежит город. Пиши по-русски, используй эмодзи, будь краток."
         f"Описывай только реально существующие города, если не знаешь - лучше честно ответь что информацию не нашел.")
-    try:
-        response = await model.generate_content_async(prompt)
-        return response.text
-    except Exception as e:
-        logging.error(f"Ошибка Gemini: {e}")
+    async with _gemini_semaphore:
+        start = time.perf_counter()
+        try:
+            text = (await asyncio.wait_for(_generate(prompt, progress), timeout=GEMINI_TIMEOUT)).strip()
+        except Exception as e:
+            result = "timeout" if isinstance(e, asyncio.TimeoutError) else "error"
+            METRICS.inc("cities_gemini_requests_total", result=result)
+            logging.error(f"Ошибка Gemini ({city}): {e!r}")
+            return None
+        finally:
+            METRICS.observe("cities_gemini_seconds", time.perf_counter() - start)
+    METRICS.inc("cities_gemini_requests_total", result="ok")
+    CITY_FACTS.put(city, text)
+    return text
+
+
+class FactsStream:
+    """Справка о городе, которая генерируется прямо сейчас. Текст растет по мере ответа ИИ,
+    подписчики (asyncio.Event) узнают о каждом новом куске; result - итог, None при ошибке."""
+
+    def __init__(self, city: str):
+        self.city = city
+        self.text = ""
+        self.result: Optional[str] = None
+        self.done = False
+        self.task: Optional[asyncio.Task] = None
+        self.listeners: set = set()
+        # Запрошена только предзагрузкой: пока справку никто не ждет, запрос можно отменить
+        self.speculative = False
+
+    @classmethod
+    def finished(cls, city: str, text: str) -> "FactsStream":
+        stream = cls(city)
+        stream.text = stream.result = text
+        stream.done = True
+        return stream
+
+    def _notify(self):
+        for event in self.listeners:
+            event.set()
+
+    def update(self, text: str):
+        self.text = text
+        self._notify()
+
+    def finish(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is None:
+            self.result = task.result()
+        self.done = True
+        self._notify()
+
+
+_facts_in_flight: Dict[str, FactsStream] = {}
+
+
+def facts_stream(city: str, speculative: bool = False) -> FactsStream:
+    """Справка из кэша или общий для всех ждущих запрос к ИИ"""
+    cached = CITY_FACTS.get(city)
+    if cached is not None:
+        return FactsStream.finished(city, cached)
+
+    norm = normalize_city(city)
+    stream = _facts_in_flight.get(norm)
+    if stream is not None and not speculative:
+        stream.speculative = False
+    if stream is None:
+        stream = _facts_in_flight[norm] = FactsStream(city)
+        stream.speculative = speculative
+        stream.task = asyncio.create_task(_fetch_city_info(city, stream.update))
+
+        def on_done(task: asyncio.Task):
+            _facts_in_flight.pop(norm, None)
+            stream.finish(task)
+
+        stream.task.add_done_callback(on_done)
+    return stream
+
+
+def format_facts(blocks: List[Optional[str]]) -> str:
+    found = [block for block in blocks if block]
+    if not found:
         return "\n⚠️ Не удалось загрузить факты (ошибка ИИ), но города верные!"
+    text = "\n\n".join(found)
+    if len(found) < len(blocks):
+        text += "\n\n⚠️ Про один из городов факты загрузить не удалось."
+    return text
+
+
+# Теги, которые понимает Telegram (без атрибутов - ИИ они не нужны)
+_HTML_TAGS = {"b", "strong", "i", "em", "u", "ins", "s", "strike", "del", "code", "tg-spoiler"}
+_HTML_TOKEN = re.compile(r"<(/?)([a-zA-Z][\w-]*)[^<>]*>|&(?:lt|gt|amp|quot|#\d+|#x[0-9a-fA-F]+);|[<>&]")
+_HTML_TAIL = re.compile(r"<[^<>]*$|&#?\w*$")
+
+
+def sanitize_html(text: str, partial: bool = False) -> str:
+    """Приводит HTML от ИИ к виду, который примет parse_mode="HTML": неизвестные теги и одиночные
+    <, >, & экранируются, лишние закрывающие теги выбрасываются, незакрытые - закрываются.
+    partial - текст оборван на полуслове: недописанный тег или сущность в конце отрезаются."""
+    if partial:
+        text = _HTML_TAIL.sub("", text)
+    out: List[str] = []
+    stack: List[str] = []
+    pos = 0
+    for m in _HTML_TOKEN.finditer(text):
+        out.append(text[pos:m.start()])
+        pos = m.end()
+        token = m.group(0)
+        name = (m.group(2) or "").lower()
+        if name not in _HTML_TAGS:
+            out.append(token if token.startswith("&") and len(token) > 1 else html.escape(token, quote=False))
+        elif not m.group(1):
+            stack.append(name)
+            out.append(f"<{name}>")
+        elif name in stack:
+            # Закрываем и все, что было открыто внутри: Telegram требует правильной вложенности
+            while stack:
+                top = stack.pop()
+                out.append(f"</{top}>")
+                if top == name:
+                    break
+    out.append(text[pos:])
+    out.extend(f"</{name}>" for name in reversed(stack))
+    return "".join(out)
+
+
+# --- ПОСЛЕДОВАТЕЛЬНАЯ ОБРАБОТКА АПДЕЙТОВ ПОЛЬЗОВАТЕЛЯ ---
+class UserEventIsolation(BaseEventIsolation):
+    """Апдейты одного пользователя обрабатываются строго по очереди, разных - параллельно.
+    В отличие от SimpleEventIsolation, замок удаляется, когда его больше никто не ждет."""
+
+    def __init__(self):
+        # ключ -> [замок, сколько апдейтов его держат или ждут]
+        self._locks: Dict[StorageKey, List[Any]] = {}
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def close(self) -> None:
+        self._locks.clear()
+
+
+class BufferedFSMContext(FSMContext):
+    """FSMContext, который копит изменения в памяти и пишет их в хранилище
+    одним commit() по окончании обработки апдейта"""
+
+    _UNSET = object()
+
+    def __init__(self, storage: BaseStorage, key: StorageKey):
+        super().__init__(storage, key)
+        self._state: Any = self._UNSET
+        self._data: Optional[Dict[str, Any]] = None
+        self._state_dirty = False
+        self._data_dirty = False
+
+    async def get_state(self) -> Optional[str]:
+        if self._state is self._UNSET:
+            self._state = await self.storage.get_state(self.key)
+        return self._state.state if isinstance(self._state, State) else self._state
+
+    async def set_state(self, state: StateType = None) -> None:
+        self._state = state
+        self._state_dirty = True
+
+    async def get_data(self) -> Dict[str, Any]:
+        if self._data is None:
+            # Глубокая копия: mark_city_used меняет used_ids и счетчики на месте,
+            # а до commit() хранилище не должно видеть ничего из этого апдейта
+            self._data = copy.deepcopy(await self.storage.get_data(self.key))
+        return self._data
+
+    async def set_data(self, data: Dict[str, Any]) -> None:
+        self._data = dict(data)
+        self._data_dirty = True
+
+    async def get_value(self, key: str, default: Any = None) -> Any:
+        return (await self.get_data()).get(key, default)
+
+    async def update_data(self, data: Optional[Dict[str, Any]] = None, **kwargs: Any) -> Dict[str, Any]:
+        if data:
+            kwargs.update(data)
+        current = await self.get_data()
+        current.update(kwargs)
+        self._data_dirty = True
+        return current.copy()
+
+    async def commit(self):
+        if self._state_dirty:
+            await self.storage.set_state(self.key, self._state)
+            self._state_dirty = False
+        if self._data_dirty:
+            await self.storage.set_data(self.key, self._data)
+            self._data_dirty = False
+
+
+class StateBatchMiddleware(BaseMiddleware):
+    """Подменяет state на BufferedFSMContext: все изменения апдейта уходят в хранилище разом.
+    Если обработчик упал, буфер выбрасывается: полхода в хранилище не попадает."""
+
+    async def __call__(self, handler, event, data):
+        state = data.get("state")
+        if state is None:
+            return await handler(event, data)
+        buffered = BufferedFSMContext(state.storage, state.key)
+        data["state"] = buffered
+        result = await handler(event, data)
+        await buffered.commit()
+        return result
+
+
+# --- ИСХОДЯЩИЕ ЗАПРОСЫ: ЛИМИТЫ TELEGRAM И СКЛЕЙКА ОТВЕТОВ ---
+PRIORITY_HIGH = 0  # новые сообщения и ответы на нажатия кнопок
+PRIORITY_NORMAL = 1  # правки уже отправленных сообщений
+PRIORITY_LOW = 2  # "печатает...": если лимит исчерпан, не отправляется вовсе
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, в запасе не больше burst.
+    Ожидающие получают токены по приоритету, при равном - в порядке очереди."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, cost: float = 1) -> bool:
+        """Взять cost токенов без ожидания; очередь ожидающих не обгоняем"""
+        self._refill()
+        if self._waiters or self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    async def acquire(self, priority: int = PRIORITY_NORMAL):
+        if self.try_acquire():
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, waiter))
+        self._schedule()
+        await waiter
+
+    def pause(self, seconds: float):
+        """После 429: до конца паузы токенов не будет ни у кого"""
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def idle(self) -> bool:
+        self._refill()
+        return not self._waiters and self.tokens >= self.burst
+
+    def _schedule(self):
+        if self._timer is None and self._waiters:
+            delay = max(0.0, (1 - self.tokens) / self.rate)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._wake)
+
+    def _wake(self):
+        self._timer = None
+        self._refill()
+        while self._waiters and (self._waiters[0][2].done() or self.tokens >= 1):
+            _, _, waiter = heapq.heappop(self._waiters)
+            # Отмененное ожидание токен не тратит
+            if not waiter.done():
+                self.tokens -= 1
+                waiter.set_result(None)
+        self._schedule()
+
+
+class FloodControlMiddleware(BaseRequestMiddleware):
+    """Все запросы бота к Bot API проходят через общую корзину и корзину своего чата.
+    На 429 чат (или весь бот, если у метода нет чата) замирает на retry_after, и запрос повторяется."""
+
+    # Корзины чатов, которые полны и никого не ждут, чистятся, когда их становится больше
+    MAX_IDLE_CHATS = 10000
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float, max_retries: int = 3):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.chats: Dict[Any, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= self.MAX_IDLE_CHATS:
+                self.chats = {key: b for key, b in self.chats.items() if not b.idle()}
+            bucket = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    @staticmethod
+    def priority(method) -> int:
+        if isinstance(method, SendChatAction):
+            return PRIORITY_LOW
+        if isinstance(method, (EditMessageText, EditMessageReplyMarkup)):
+            return PRIORITY_NORMAL
+        return PRIORITY_HIGH
+
+    async def __call__(self, make_request, bot: Bot, method):
+        name = type(method).__name__
+        chat_id = getattr(method, "chat_id", None)
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+        priority = self.priority(method)
+
+        if priority == PRIORITY_LOW:
+            if (chat_bucket and not chat_bucket.try_acquire()) or not self.global_bucket.try_acquire():
+                METRICS.inc("cities_outbound_dropped_total", method=name)
+                return True
+            return await make_request(bot, method)
+
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            if chat_bucket:
+                await chat_bucket.acquire(priority)
+            await self.global_bucket.acquire(priority)
+            METRICS.observe("cities_outbound_wait_seconds", time.perf_counter() - start, method=name)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                METRICS.inc("cities_outbound_retry_after_total", method=name)
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                logging.warning(f"429 на {name} (чат {chat_id}), повтор через {e.retry_after} с")
+                (chat_bucket or self.global_bucket).pause(e.retry_after)
+
+
+class Outbox:
+    """Сообщения, отправленные обработчиком через reply(), копятся до конца апдейта.
+    Подряд идущие сообщения в один чат уходят одним сообщением в HTML."""
+
+    MAX_TEXT = 4096
+
+    def __init__(self):
+        # (сообщение, на которое отвечаем, HTML-текст, клавиатура, future с отправленным Message)
+        self.items: List[Tuple[Message, str, Any, asyncio.Future]] = []
+
+    def add(self, message: Message, text: str, parse_mode: Optional[str], reply_markup) -> asyncio.Future:
+        if parse_mode != "HTML":
+            text = html.escape(text)
+        sent = asyncio.get_running_loop().create_future()
+        self.items.append((message, text, reply_markup, sent))
+        return sent
+
+    def _fits(self, group: List[Any], text: str, reply_markup) -> bool:
+        if sum(len(t) + 2 for t in group[1]) + len(text) > self.MAX_TEXT:
+            return False
+        # У сообщения одна клавиатура: inline-кнопки и обычную клавиатуру не совместить
+        return group[2] is None or not isinstance(reply_markup, InlineKeyboardMarkup)
+
+    def groups(self) -> List[List[Any]]:
+        """[сообщение, тексты, клавиатура, futures] - по одному на каждое исходящее сообщение"""
+        groups: List[List[Any]] = []
+        open_groups: Dict[int, List[Any]] = {}
+        for message, text, reply_markup, sent in self.items:
+            chat_id = message.chat.id
+            group = open_groups.get(chat_id)
+            if group is None or not self._fits(group, text, reply_markup):
+                group = open_groups[chat_id] = [message, [], None, []]
+                groups.append(group)
+            group[1].append(text)
+            group[3].append(sent)
+            if reply_markup is not None:
+                group[2] = reply_markup
+            # Кнопки относятся к тексту над ними, следующий ответ - уже новое сообщение
+            if isinstance(reply_markup, InlineKeyboardMarkup):
+                del open_groups[chat_id]
+        return groups
+
+    async def flush(self):
+        groups = self.groups()
+        self.items = []
+        try:
+            for message, texts, reply_markup, futures in groups:
+                if len(texts) > 1:
+                    METRICS.inc("cities_outbound_merged_total", len(texts) - 1)
+                try:
+                    sent = await message.answer("\n\n".join(texts), parse_mode="HTML", reply_markup=reply_markup)
+                except TelegramBadRequest as e:
+                    if len(texts) == 1:
+                        raise
+                    # Одна битая часть не должна съедать остальные: шлем их по отдельности,
+                    # клавиатура остается у последней
+                    logging.warning(f"Merged reply rejected, sending {len(texts)} parts separately: {e}")
+                    for i, (text, future) in enumerate(zip(texts, futures)):
+                        try:
+                            future.set_result(await message.answer(
+                                text, parse_mode="HTML", reply_markup=reply_markup if i == len(texts) - 1 else None))
+                        except TelegramBadRequest as e:
+                            logging.error(f"Reply rejected by Telegram: {e}")
+                    continue
+                for future in futures:
+                    future.set_result(sent)
+        finally:
+            for _, _, _, futures in groups:
+                for future in futures:
+                    if not future.done():
+                        future.cancel()
+
+
+_OUTBOX: ContextVar[Optional[Outbox]] = ContextVar("outbox", default=None)
+
+
+async def reply(message: Message, text: str, parse_mode: Optional[str] = None, reply_markup=None) -> asyncio.Future:
+    """Как message.answer(), но внутри обработчика ответ уходит в конце апдейта, склеенным
+    с остальными ответами в этот чат. Возвращает future с отправленным Message."""
+    outbox = _OUTBOX.get()
+    if outbox is not None:
+        return outbox.add(message, text, parse_mode, reply_markup)
+    sent = asyncio.get_running_loop().create_future()
+    sent.set_result(await message.answer(text, parse_mode=parse_mode, reply_markup=reply_markup))
+    return sent
+
+
+class OutboxMiddleware(BaseMiddleware):
+    """Собирает ответы обработчика и отправляет их после того, как состояние сохранено"""
+
+    async def __call__(self, handler, event, data):
+        outbox = Outbox()
+        token = _OUTBOX.set(outbox)
+        try:
+            return await handler(event, data)
+        finally:
+            _OUTBOX.reset(token)
+            await outbox.flush()
+
+
+# --- ПРЕДЗАГРУЗКА СПРАВОК ---
+class FactsPrefetcher:
+    """Запрашивает справки к ответу бота сразу после отправки, пока игрок не нажал кнопку.
+    Задания хранятся по (chat_id, message_id) не дольше ttl; ждут в очереди не больше max_queued,
+    выполняются не больше concurrency за раз, а запросы к ИИ ограничены budget в час.
+    Готовые справки попадают в общий кэш, поэтому кнопка отвечает сразу."""
+
+    def __init__(self, rate: float, budget: float, concurrency: int, max_queued: int, ttl: float):
+        self.rate = rate
+        self.budget = TokenBucket(budget / 3600, max(1.0, budget / 60))
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.ttl = ttl
+        # ключ -> [когда создано, города, задача или None, потоки справок], от старых к новым
+        self.jobs: "OrderedDict[Tuple[int, int], List[Any]]" = OrderedDict()
+        self.queue: deque = deque()
+        self.running = 0
+
+    def after_sent(self, sent: asyncio.Future, cities: List[str]):
+        """Поставить предзагрузку, когда сообщение с кнопкой будет отправлено (sent - future от reply())"""
+        if random.random() >= self.rate:
+            return
+
+        def on_sent(future: asyncio.Future):
+            if not future.cancelled() and future.exception() is None:
+                self.submit(future.result().chat.id, future.result().message_id, cities)
+
+        sent.add_done_callback(on_sent)
+
+    def submit(self, chat_id: int, message_id: int, cities: List[str]):
+        # Новый ответ в чате: кнопку у прошлого уже вряд ли нажмут
+        self.cancel_chat(chat_id)
+        self._evict()
+        if all(CITY_FACTS.get(city) is not None or normalize_city(city) in _facts_in_flight for city in cities):
+            METRICS.inc("cities_facts_prefetch_total", result="cached")
+            return
+        if len(self.queue) >= self.max_queued:
+            METRICS.inc("cities_facts_prefetch_total", result="queue_full")
+            return
+        key = (chat_id, message_id)
+        self.jobs[key] = [time.monotonic(), cities, None, []]
+        self.queue.append(key)
+        asyncio.get_running_loop().call_later(self.ttl, self._evict)
+        self._pump()
+
+    def claim(self, chat_id: int, message_id: int):
+        """Игрок нажал кнопку: справки по этому сообщению больше не предположительные"""
+        if self.jobs.pop((chat_id, message_id), None) is not None:
+            METRICS.inc("cities_facts_prefetch_total", result="claimed")
+
+    def cancel(self, key: Tuple[int, int], result: str = "cancelled"):
+        job = self.jobs.pop(key, None)
+        if job is None:
+            return
+        METRICS.inc("cities_facts_prefetch_total", result=result)
+        if job[2] is None:
+            self.queue.remove(key)
+        else:
+            job[2].cancel()
+        # Запрос к ИИ отменяем, только если справку так никто и не попросил
+        for stream in job[3]:
+            if stream.speculative and stream.task is not None:
+                stream.task.cancel()
+
+    def cancel_chat(self, chat_id: int):
+        for key in [key for key in self.jobs if key[0] == chat_id]:
+            self.cancel(key)
+
+    def close(self):
+        for key in list(self.jobs):
+            self.cancel(key)
+
+    def _evict(self):
+        deadline = time.monotonic() - self.ttl
+        while self.jobs:
+            key, job = next(iter(self.jobs.items()))
+            if job[0] > deadline:
+                break
+            self.cancel(key, result="expired")
+
+    def _pump(self):
+        while self.running < self.concurrency and self.queue:
+            key = self.queue.popleft()
+            job = self.jobs.get(key)
+            if job is None:
+                continue
+            missing = [city for city in job[1]
+                       if CITY_FACTS.get(city) is None and normalize_city(city) not in _facts_in_flight]
+            if not missing or not self.budget.try_acquire(len(missing)):
+                del self.jobs[key]
+                METRICS.inc("cities_facts_prefetch_total", result="no_budget" if missing else "cached")
+                continue
+            METRICS.inc("cities_facts_prefetch_total", result="started")
+            self.running += 1
+            job[2] = asyncio.create_task(self._run(job))
+
+    async def _run(self, job: List[Any]):
+        try:
+            job[3] = [facts_stream(city, speculative=True) for city in job[1]]
+            tasks = [stream.task for stream in job[3] if stream.task is not None]
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            self.running -= 1
+            self._pump()
+
+
+def make_prefetcher(workers: int = 1) -> FactsPrefetcher:
+    return FactsPrefetcher(FACTS_PREFETCH_RATE, FACTS_PREFETCH_BUDGET / max(1, workers), FACTS_PREFETCH_CONCURRENCY,
+                           FACTS_PREFETCH_QUEUE, FACTS_PREFETCH_TTL)
+
+
+FACTS_PREFETCH = make_prefetcher()
 
 
 # --- БОТ ---
@@ -202,19 +2626,78 @@ game_kb = ReplyKeyboardMarkup(
     resize_keyboard=True
 )
 
-dp = Dispatcher(storage=PickleFileStorage("bot_state.pkl"))
+# Пока open_storages не подставил настоящее хранилище, у диспетчера MemoryStorage по умолчанию
+dp = Dispatcher(events_isolation=UserEventIsolation())
+dp.message.middleware(MetricsMiddleware())
+dp.callback_query.middleware(MetricsMiddleware())
+dp.message.middleware(OutboxMiddleware())
+dp.callback_query.middleware(OutboxMiddleware())
+dp.message.middleware(StateBatchMiddleware())
+dp.callback_query.middleware(StateBatchMiddleware())
+
+
+def open_storages(state_path: Optional[str] = None):
+    """Хранилище игр, рекорды и кэш фактов. Открываются в том процессе, который с ними работает,
+    а не при импорте: соединения SQLite (и их потоки) нельзя переносить через fork() в воркеры."""
+    global HIGH_SCORES, CITY_FACTS
+    dp.fsm.storage = make_storage(state_path or STORAGE_PATH)
+    HIGH_SCORES = make_high_scores(HIGHSCORES_FILE)
+    CITY_FACTS = make_facts_cache(FACTS_CACHE_FILE)
+
+
+METRICS.gauge("cities_active_games",
+              lambda: dp.storage.count_states(GameState.playing.state) if hasattr(dp.storage, "count_states") else 0)
+METRICS.gauge("cities_storage_hot_sessions", lambda: len(getattr(dp.storage, "data", ())))
+METRICS.gauge("cities_catalog_version", lambda: CITY_CATALOG.version)
+METRICS.gauge("cities_catalog_cities", lambda: len(CITIES_KEYS))
+
+
+async def end_game(state: FSMContext):
+    """Как state.clear(), но выбранная сложность остается на следующие игры"""
+    difficulty = (await state.get_data()).get("difficulty")
+    await state.clear()
+    if difficulty:
+        await state.update_data(difficulty=difficulty)
 
 
 @dp.message(Command("start"))
 async def command_start_handler(message: Message, state: FSMContext) -> None:
+    cancel_facts(message.chat.id)
+    difficulty = (await state.get_data()).get("difficulty")
     await state.clear()
     await state.set_state(GameState.playing)
-    await state.update_data(used_cities=[], last_letter=None, penult_letter=None, score=0)
-    await message.answer("""Привет! Давай играть в Города?🌏
-Напиши название любого города, а я не только отвечу тебе, но и подберу к нему интересные факты с помощью ИИ🤖""",
+    await state.update_data(**new_game_data(difficulty))
+    await reply(message, """Привет! Давай играть в Города?🌏
+Напиши название любого города, а я не только отвечу тебе, но и подберу к нему интересные факты с помощью ИИ🤖
+Сложность игры можно поменять командой /level""",
                          reply_markup=game_kb)
 
 
+DIFFICULTY_NAMES = {"normal": "😊 Обычный", "hard": "😈 Сложный"}
+
+
+@dp.message(Command("level"))
+async def level_handler(message: Message, state: FSMContext):
+    current = (await state.get_data()).get("difficulty", "normal")
+    kb = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=("✅ " if key == current else "") + name, callback_data=f"level_{key}")
+        for key, name in DIFFICULTY_NAMES.items()
+    ]])
+    await reply(message, "Выбери сложность:\n😊 Обычный - я отвечаю известными городами\n"
+                         "😈 Сложный - выбираю город, на последнюю букву которого у тебя меньше всего вариантов",
+                         reply_markup=kb)
+
+
+@dp.callback_query(F.data.startswith("level_"))
+async def level_callback_handler(callback: CallbackQuery, state: FSMContext):
+    difficulty = callback.data.split("_", 1)[1]
+    if difficulty not in DIFFICULTY_NAMES:
+        await callback.answer()
+        return
+    await state.update_data(difficulty=difficulty)
+    await callback.message.edit_text(f"Сложность: <b>{DIFFICULTY_NAMES[difficulty]}</b>", parse_mode="HTML")
+
+
 @dp.message(Command("stop"), GameState.playing)
 @dp.message(F.text == "🔄 Закончить текущую игру", GameState.playing)
 async def stop_game(message: Message, state: FSMContext):
@@ -222,56 +2705,80 @@ async def stop_game(message: Message, state: FSMContext):
     current_score = data.get("score", 0)
     user_id = message.from_user.id
 
-    is_new_record = save_high_score(user_id, current_score)
+    is_new_record = save_high_score(user_id, current_score, message.from_user.full_name)
     high_score = get_high_score(user_id)
 
     text = f"Игра окончена! Твой счет: <b>{current_score}</b>.\nЛучший рекорд: <b>{high_score}</b> 🏆"
     if is_new_record:
         text += "\n🎉 Поздравляю! Это новый рекорд!"
 
-    await message.answer(text, parse_mode="HTML", reply_markup=types.ReplyKeyboardRemove())
+    await reply(message, text, parse_mode="HTML", reply_markup=types.ReplyKeyboardRemove())
 
+    cancel_facts(message.chat.id)
     await state.clear()
     await state.set_state(GameState.playing)
-    await state.update_data(used_cities=[], last_letter=None, penult_letter=None, score=0)
-    await message.answer("🔄 Игра перезапущена! Напиши любой город, чтобы начать заново☺️", reply_markup=game_kb)
+    await state.update_data(**new_game_data(data.get("difficulty")))
+    await reply(message, "🔄 Игра перезапущена! Напиши любой город, чтобы начать заново☺️", reply_markup=game_kb)
+
+
+@dp.message(Command("top"))
+async def top_handler(message: Message):
+    top = HIGH_SCORES.top(10)
+    if not top:
+        await reply(message, "Рекордов пока нет. Стань первым! 🏆")
+        return
+
+    medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+    lines = ["<b>🏆 Лучшие игроки:</b>\n"]
+    for place, (uid, score) in enumerate(top, start=1):
+        name = html.escape(HIGH_SCORES.names.get(uid, f"Игрок {uid}"))
+        lines.append(f"{medals.get(place, f'{place}.')} {name} — <b>{score}</b>")
+
+    my_rank = HIGH_SCORES.rank(message.from_user.id)
+    if my_rank:
+        lines.append(f"\nТвое место: <b>{my_rank}</b> из {len(HIGH_SCORES.scores)} "
+                     f"(рекорд {HIGH_SCORES.get(message.from_user.id)})")
+    await reply(message, "\n".join(lines), parse_mode="HTML")
+
+
+@dp.message(Command("reload_catalog"), lambda message: message.from_user.id in ADMIN_IDS)
+async def reload_catalog_handler(message: Message):
+    """Перечитать cities.txt и top_cities.txt, не дожидаясь проверки по таймеру.
+    С WORKERS > 1 команда перезагружает только воркер этого админа, остальные подхватят файлы сами."""
+    try:
+        changed = await reload_catalog()
+    except Exception as e:
+        logging.exception(f"Error reloading catalog: {e}")
+        await reply(message, f"Не удалось перезагрузить каталог: {html.escape(str(e))}")
+        return
+    status = "перезагружен" if changed else "не менялся"
+    await reply(message, f"Каталог {status}: версия <b>{CITY_CATALOG.version}</b>, городов <b>{len(CITIES_KEYS)}</b>",
+                parse_mode="HTML")
 
 
 @dp.message(F.text == "💡 Подсказка", GameState.playing)
 async def give_hint(message: Message, state: FSMContext):
     data = await state.get_data()
     last_letter = data.get("last_letter")
-    used_cities = set(data.get("used_cities", []))
 
     if not last_letter:
-        await message.answer("Твой ход, назови любой город☺️")
+        await reply(message, "Твой ход, назови любой город☺️")
         return
 
     # Логика поиска подсказки (сначала в топ, потом везде)
-    top_candidates = [
-        CITIES_MAP[norm] for norm in CITIES_MAP
-        if norm.startswith(last_letter) and norm not in used_cities and norm in TOP_CITIES_NORM
-    ]
-
-    candidates = top_candidates if top_candidates else [
-        CITIES_MAP[norm] for norm in CITIES_MAP
-        if norm.startswith(last_letter) and norm not in used_cities
-    ]
+    hint_norm = pick_city(data, last_letter)
 
-    if not candidates:
+    if not hint_norm:
         # Если городов на основную букву нет, пробуем найти на предпоследнюю (если правило активно)
         penult = data.get("penult_letter")
         if penult:
-            candidates = [
-                CITIES_MAP[norm] for norm in CITIES_MAP
-                if norm.startswith(penult) and norm not in used_cities
-            ]
+            hint_norm = pick_city(data, penult, prefer_top=False)
 
-    if not candidates:
-        await message.answer("Города кончились совсем! Ты победил!🏆")
-        await state.clear()
+    if not hint_norm:
+        await reply(message, "Города кончились совсем! Ты победил!🏆")
+        await end_game(state)
     else:
-        await message.answer(f"Попробуй: <code>{random.choice(candidates)}</code> 🤫", parse_mode="HTML")
+        await reply(message, f"Попробуй: <code>{CITIES_MAP[hint_norm]}</code> 🤫", parse_mode="HTML")
 
 
 # ЛОГИКА ИГРЫ
@@ -279,27 +2786,29 @@ async def give_hint(message: Message, state: FSMContext):
 async def play_game(message: Message, state: FSMContext):
     user_text = message.text.strip()
 
-    match_result = find_best_match(user_text)
+    data = await state.get_data()
+
+    match_result = find_best_match(user_text, letter=data.get("last_letter"))
     if not match_result:
-        await message.answer(
+        await reply(
+            message,
             "Не знаю такого города или опечатка сильная 🤷‍♂️\nЕсли застрял, то ты всегда можешь воспользоваться подсказкой👇")
         return
 
     found_norm, found_real = match_result
 
     if normalize_city(user_text) != found_norm:
-        await message.answer(f"Города <b>{user_text}</b> я не знаю, но думаю, ты имел в виду: <b>{found_real}</b>?",
+        await reply(message, f"Города <b>{html.escape(user_text)}</b> я не знаю, но думаю, ты имел в виду: <b>{found_real}</b>?",
                              parse_mode="HTML")
 
     # ПРОВЕРКА ПРАВИЛ
-    data = await state.get_data()
-    used_cities = set(data.get("used_cities", []))
     expected_letter = data.get("last_letter")
     expected_penult = data.get("penult_letter")
     current_score = data.get("score", 0)
 
-    if found_norm in used_cities:
-        await message.answer(
+    if is_city_used(data, found_norm):
+        await reply(
+            message,
             f"Город {found_real} уже был, попробуй другой🙏\nТакже ты можешь воспользоваться подсказкой👇")
         return
 
@@ -313,62 +2822,55 @@ async def play_game(message: Message, state: FSMContext):
             allowed_rescue = False
             if is_penult_ok:
                 # Проверяем, действительно ли кончились города на основную букву
-                remaining_on_primary = [
-                    c for c in CITIES_MAP
-                    if c.startswith(expected_letter) and c not in used_cities
-                ]
-                if not remaining_on_primary:
+                if sum(remaining_on_letter(data, expected_letter)) == 0:
                     allowed_rescue = True
-                    await message.answer(
+                    await reply(
+                        message,
                         f"Города на <b>'{expected_letter.upper()}'</b> закончились. Принимаю ответ на предпоследнюю букву <b>'{expected_penult.upper()}'</b>! 🤝",
                         parse_mode="HTML"
                     )
                 else:
-                    await message.answer(
+                    await reply(
+                        message,
                         f"Рано сдаешься! Города на букву <b>'{expected_letter.upper()}'</b> еще есть 😉. Я знаю как минимум один.",
                         parse_mode="HTML"
                     )
                     return  # Не пускаем дальше
 
             if not allowed_rescue:
-                await message.answer(
+                await reply(
+                    message,
                     f"Нужно на букву <b>{expected_letter.upper()}</b>!\nЕсли застрял, то ты всегда можешь воспользоваться подсказкой👇",
                     parse_mode="HTML")
                 return
 
     # 3. Ход пользователя принят
-    current_used = data.get("used_cities", [])
-    current_used.append(found_norm)
+    mark_city_used(data, found_norm)
     current_score += 1
 
-    await state.update_data(used_cities=current_used, score=current_score)
+    await state.update_data(used_ids=data["used_ids"], letters_used=data["letters_used"],
+                            transitions_used=data["transitions_used"], score=current_score, pending_continue=None)
 
     # 4. Логика ответа бота
-    last_char_for_bot = get_last_valid_char(found_real)
+    last_char_for_bot, _ = city_letters(found_norm)
 
-    await make_bot_move(message, state, last_char_for_bot, found_real)
+    await make_bot_move(message, state, last_char_for_bot, found_real, message.from_user)
 
 
 # ХОД БОТА
-async def make_bot_move(message: Message, state: FSMContext, letter: str, user_real_city: str):
+async def make_bot_move(message: Message, state: FSMContext, letter: str, user_real_city: str,
+                        player: types.User):
+    """message - куда отвечать; после "Продолжить" это сообщение бота, поэтому игрок передается отдельно"""
     data = await state.get_data()
-    current_used = data.get("used_cities", [])
     current_score = data.get("score", 0)
 
-    all_candidates_norm = [
-        norm for norm in CITIES_MAP
-        if norm.startswith(letter) and norm not in current_used
-    ]
+    top_left, other_left = remaining_on_letter(data, letter)
 
     # ЕСЛИ У БОТА НЕТ ГОРОДОВ
-    if not all_candidates_norm:
+    if top_left + other_left <= 0:
         penultimate_char = get_penultimate_valid_char(user_real_city)
 
-        can_continue = False
-        if penultimate_char:
-            check_candidates = [n for n in CITIES_MAP if n.startswith(penultimate_char) and n not in current_used]
-            if check_candidates:
-                can_continue = True
+        can_continue = bool(penultimate_char) and sum(remaining_on_letter(data, penultimate_char)) > 0
 
         if can_continue:
             kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -376,36 +2878,38 @@ async def make_bot_move(message: Message, state: FSMContext, letter: str, user_r
                                       callback_data=f"cont_{penultimate_char}")],
                 [InlineKeyboardButton(text="🏳️ Забрать победу", callback_data="stop_win")]
             ])
-            await message.answer(
+            await state.update_data(pending_continue=penultimate_char)
+            await reply(
+                message,
                 f"Ого! Ты назвал <b>{user_real_city}</b>. Города на букву <b>'{letter.upper()}'</b> у меня закончились! 🤯\n\n"
                 f"Ты можешь закончить игру победителем или дать мне шанс отыграться на предпоследнюю букву (<b>'{penultimate_char.upper()}'</b>).",
                 reply_markup=kb, parse_mode="HTML"
             )
             return
         else:
-            save_high_score(message.from_user.id, current_score)
-            await message.answer(
+            save_high_score(player.id, current_score, player.full_name)
+            await reply(
+                message,
                 f"Ты назвал <b>{user_real_city}</b>. Мне нечем ответить ни на '{letter.upper()}', ни на предпоследнюю букву. Абсолютная победа! 🏆\n"
                 f"Твой итоговый счет: {current_score}", parse_mode="HTML")
-            await state.clear()
+            await end_game(state)
             return
 
     # ВЫБОР ГОРОДА
-    top_candidates = [norm for norm in all_candidates_norm if norm in TOP_CITIES_NORM]
-
-    if top_candidates:
-        bot_norm = random.choice(top_candidates)
+    if data.get("difficulty") == "hard":
+        bot_norm = pick_city_hard(data, letter)
     else:
-        bot_norm = random.choice(all_candidates_norm)
+        bot_norm = pick_city(data, letter)
 
     bot_answer = CITIES_MAP[bot_norm]
-    current_used.append(bot_norm)
+    mark_city_used(data, bot_norm)
 
-    next_letter_for_user = get_last_valid_char(bot_answer)
-    next_penult_for_user = get_penultimate_valid_char(bot_answer)
+    next_letter_for_user, next_penult_for_user = city_letters(bot_norm)
 
     await state.update_data(
-        used_cities=current_used,
+        used_ids=data["used_ids"],
+        letters_used=data["letters_used"],
+        transitions_used=data["transitions_used"],
         last_letter=next_letter_for_user,
         penult_letter=next_penult_for_user
     )
@@ -421,7 +2925,8 @@ async def make_bot_move(message: Message, state: FSMContext, letter: str, user_r
         f"<i>(Счет: {current_score})</i>"
     )
 
-    await message.answer(response_text, parse_mode="HTML", reply_markup=inline_kb)
+    sent = await reply(message, response_text, parse_mode="HTML", reply_markup=inline_kb)
+    FACTS_PREFETCH.after_sent(sent, [user_real_city, bot_answer])
 
 
 # ОБРАБОТЧИКИ КНОПОК
@@ -429,58 +2934,345 @@ async def make_bot_move(message: Message, state: FSMContext, letter: str, user_r
 @dp.callback_query(F.data == "stop_win")
 async def stop_win_handler(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
+    # Повторное нажатие (или старая кнопка) - игра уже закончена или продолжена
+    if not data.get("pending_continue"):
+        await callback.answer("Эта игра уже завершена 😉")
+        return
     score = data.get("score", 0)
-    save_high_score(callback.from_user.id, score)
+    save_high_score(callback.from_user.id, score, callback.from_user.full_name)
 
     await callback.message.edit_text(
         f"Ты решил забрать кубок! 🏆\nФинальный счет: <b>{score}</b>.\nМожешь начать новую игру /start",
         parse_mode="HTML"
     )
-    await state.clear()
+    await end_game(state)
 
 
 @dp.callback_query(F.data.startswith("cont_"))
 async def continue_game_handler(callback: CallbackQuery, state: FSMContext):
     new_letter = callback.data.split("_")[1]
 
+    data = await state.get_data()
+    if data.get("pending_continue") != new_letter:
+        await callback.answer("Игра уже продолжена 😉")
+        return
+    await state.update_data(pending_continue=None)
+
     text = callback.message.text or ""
     match = re.search(r"Ты назвал (.+)\.", text)
     user_city_real = match.group(1).strip() if match else "Твой город"
 
     await callback.message.edit_text(f"🤝 Благородно! Продолжаем на букву <b>{new_letter.upper()}</b>...",
                                      parse_mode="HTML")
-    await make_bot_move(callback.message, state, new_letter, user_city_real)
+    await make_bot_move(callback.message, state, new_letter, user_city_real, callback.from_user)
+
+
+# Справки, которые сейчас дописываются в сообщения: (chat_id, message_id) -> задача
+_facts_edits: Dict[Tuple[int, int], asyncio.Task] = {}
+
+
+def cancel_facts(chat_id: int):
+    """Новая игра: перестаем дописывать справки в старые сообщения чата.
+    Сами запросы к ИИ не отменяются - их ждут другие чаты, а результат попадет в кэш."""
+    FACTS_PREFETCH.cancel_chat(chat_id)
+    for key, task in list(_facts_edits.items()):
+        if key[0] == chat_id:
+            task.cancel()
+
+
+async def stream_facts(message: Message, cities: List[str], clicked: float):
+    """Дописывает справки в сообщение по мере генерации, правя его не чаще раза в FACTS_EDIT_INTERVAL"""
+    original_html = message.html_text
+    streams = [facts_stream(city) for city in cities]
+    changed = asyncio.Event()
+    changed.set()
+    for stream in streams:
+        stream.listeners.add(changed)
+    shown = None
+    last_edit = 0.0
+    try:
+        while True:
+            await changed.wait()
+            # Куски, пришедшие за время паузы, уйдут одной правкой
+            delay = last_edit + FACTS_EDIT_INTERVAL - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            changed.clear()
+
+            done = all(stream.done for stream in streams)
+            # Каждую справку чистим отдельно: незакрытый тег одной не должен перейти на другую
+            if done:
+                facts = format_facts([sanitize_html(stream.result) if stream.result else None for stream in streams])
+            else:
+                parts = (sanitize_html(stream.text.strip(), partial=True) for stream in streams)
+                facts = "\n\n".join(part for part in parts if part)
+            if facts and facts != shown:
+                if shown is None:
+                    METRICS.observe("cities_facts_first_edit_seconds", time.perf_counter() - clicked)
+                await message.edit_text(f"{original_html}\n\n{facts}", parse_mode="HTML", reply_markup=None)
+                shown = facts
+                last_edit = time.monotonic()
+            if done:
+                return
+    except Exception as e:
+        logging.error(f"Не удалось показать справку: {e!r}")
+    finally:
+        for stream in streams:
+            stream.listeners.discard(changed)
 
 
 @dp.callback_query(F.data == "get_facts")
 async def facts_callback_handler(callback: CallbackQuery):
-    await callback.answer("Ждем ответа нейросети...🤗", show_alert=False)
-
+    clicked = time.perf_counter()
     text = callback.message.text
+    key = (callback.message.chat.id, callback.message.message_id)
 
     match_user = re.search(r"Принято:\s+(.+)", text)
     match_bot = re.search(r"Мой ответ:\s+(.+)", text)
 
-    if match_user and match_bot:
-        city_1 = match_user.group(1).strip()
-        city_2 = match_bot.group(1).strip()
+    if not (match_user and match_bot):
+        await callback.answer("Не удалось определить города :(", show_alert=True)
+        return
+    if key in _facts_edits:
+        await callback.answer("Справка уже загружается 😉")
+        return
+    await callback.answer("Ждем ответа нейросети...🤗", show_alert=False)
+    FACTS_PREFETCH.claim(*key)
+
+    city_1 = match_user.group(1).strip()
+    city_2 = match_bot.group(1).strip()
+
+    await callback.message.bot.send_chat_action(chat_id=callback.message.chat.id, action="typing")
 
-        await callback.message.bot.send_chat_action(chat_id=callback.message.chat.id, action="typing")
+    # Справка дописывается в фоне: апдейты игрока не ждут ИИ, а новая игра может ее прервать
+    task = asyncio.create_task(stream_facts(callback.message, [city_1, city_2], clicked))
+    _facts_edits[key] = task
+    task.add_done_callback(lambda _: _facts_edits.pop(key, None))
 
-        ai_facts = await get_cities_info(city_1, city_2)
 
-        original_html = callback.message.html_text
-        new_text = f"{original_html}\n\n{ai_facts}"
+_catalog_watcher: Optional[asyncio.Task] = None
 
-        await callback.message.edit_text(new_text, parse_mode="HTML", reply_markup=None)
+
+@dp.startup()
+async def on_startup():
+    global _catalog_watcher
+    if CATALOG_WATCH_INTERVAL:
+        _catalog_watcher = asyncio.create_task(watch_catalog(CATALOG_WATCH_INTERVAL))
+
+
+@dp.shutdown()
+async def on_shutdown():
+    if _catalog_watcher is not None:
+        _catalog_watcher.cancel()
+    FACTS_PREFETCH.close()
+    for task in list(_facts_edits.values()):
+        task.cancel()
+    await HIGH_SCORES.close()
+    await CITY_FACTS.close()
+
+
+def make_bot() -> Bot:
+    if TELEGRAM_API_URL:
+        bot = Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
     else:
-        await callback.answer("Не удалось определить города :(", show_alert=True)
+        bot = Bot(token=TOKEN)
+    # Общий лимит Telegram делится между процессами-обработчиками
+    bot.session.middleware(FloodControlMiddleware(FLOOD_GLOBAL_RATE / max(1, WORKERS), FLOOD_CHAT_RATE,
+                                                  FLOOD_CHAT_BURST, FLOOD_MAX_RETRIES))
+    return bot
+
+
+# --- WEBHOOK И ШАРДИРОВАНИЕ ПО ПРОЦЕССАМ ---
+def update_user_id(update: Dict[str, Any]) -> int:
+    """user_id автора апдейта (message, callback_query и т.п.), 0 если его нет"""
+    for value in update.values():
+        if isinstance(value, dict) and isinstance(value.get("from"), dict):
+            return value["from"].get("id", 0)
+    return 0
+
+
+def shard_for(user_id: int, workers: int) -> int:
+    return zlib.crc32(str(user_id).encode()) % workers
+
+
+def _worker_path(path: str, index: int) -> str:
+    root, ext = os.path.splitext(path)
+    return f"{root}.w{index}{ext}"
+
+
+class UpdateFeeder:
+    """Передает сырые апдейты в dp.feed_raw_update, не больше concurrency одновременно"""
+
+    def __init__(self, bot: Bot, concurrency: int):
+        self.bot = bot
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks: set = set()
+
+    async def submit(self, update: Dict[str, Any]):
+        await self._semaphore.acquire()
+        task = asyncio.create_task(self._feed(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _feed(self, update: Dict[str, Any]):
+        try:
+            await dp.feed_raw_update(self.bot, update)
+        except Exception as e:
+            logging.exception(f"Ошибка обработки апдейта: {e}")
+        finally:
+            self._semaphore.release()
+
+    async def drain(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+_WORKER_CONFIG = ("TOKEN", "STORAGE_MODE", "STORAGE_PATH", "SESSION_IDLE_TTL", "SESSION_MAX_HOT", "SESSION_EXPIRE",
+                  "SQLITE_PATH", "HIGHSCORES_FILE", "FACTS_CACHE_FILE",
+                  "METRICS_HOST", "METRICS_PORT", "WEBHOOK_CONCURRENCY", "TELEGRAM_API_URL", "WORKERS",
+                  "FLOOD_GLOBAL_RATE", "FLOOD_CHAT_RATE", "FLOOD_CHAT_BURST", "FLOOD_MAX_RETRIES",
+                  "FACTS_STREAMING", "FACTS_EDIT_INTERVAL", "FACTS_PREFETCH_RATE", "FACTS_PREFETCH_BUDGET",
+                  "FACTS_PREFETCH_CONCURRENCY", "FACTS_PREFETCH_QUEUE", "FACTS_PREFETCH_TTL",
+                  "CATALOG_WATCH_INTERVAL", "ADMIN_IDS")
+
+
+def worker_process(index: int, queue, config: Dict[str, Any]):
+    """Процесс-обработчик: получает апдейты своих пользователей из очереди.
+    Состояние игр, рекорды и кэш фактов - в общей базе SQLite (run_webhook проверяет STORAGE_MODE)."""
+    global FACTS_PREFETCH
+    # Останавливается по сигналу из очереди, чтобы успеть доделать начатые апдейты
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    globals().update(config)
+    open_storages(_worker_path(STORAGE_PATH, index))
+    FACTS_PREFETCH = make_prefetcher(WORKERS)
+    asyncio.run(_worker_main(index, queue))
+
+
+async def _worker_main(index: int, queue):
+    bot = make_bot()
+    feeder = UpdateFeeder(bot, WEBHOOK_CONCURRENCY)
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT + 1 + index) if METRICS_PORT else None
+    await dp.emit_startup(bot=bot)
+    logging.info(f"Воркер {index} запущен")
+    try:
+        while True:
+            update = await asyncio.to_thread(queue.get)
+            if update is None:
+                break
+            await feeder.submit(update)
+        await feeder.drain()
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+
+
+async def _webhook_server(submit, bot: Bot):
+    async def webhook_handler(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await submit(update)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    if WEBHOOK_BASE_URL:
+        await bot.set_webhook(WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                              allowed_updates=dp.resolve_used_update_types())
+    logging.info(f"Webhook слушает http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, воркеров: {WORKERS}")
+    return runner
+
+
+async def _wait_for_stop_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: остается KeyboardInterrupt
+    await stop.wait()
+
+
+async def run_webhook_single():
+    """Webhook в одном процессе: апдейты обрабатываются прямо здесь"""
+    open_storages()
+    bot = make_bot()
+    feeder = UpdateFeeder(bot, WEBHOOK_CONCURRENCY)
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    await dp.emit_startup(bot=bot)
+    runner = await _webhook_server(feeder.submit, bot)
+    try:
+        await _wait_for_stop_signal()
+    finally:
+        await runner.cleanup()
+        await feeder.drain()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+
+
+async def _run_webhook_front(queues):
+    bot = make_bot()
+
+    async def submit(update: Dict[str, Any]):
+        queues[shard_for(update_user_id(update), len(queues))].put(update)
+
+    runner = await _webhook_server(submit, bot)
+    try:
+        await _wait_for_stop_signal()
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
+
+
+def run_webhook():
+    if WORKERS <= 1:
+        asyncio.run(run_webhook_single())
+        return
+    if STORAGE_MODE != "sqlite":
+        # С файлами у каждого воркера были бы свои рекорды (/top по части игроков) и свой кэш фактов
+        raise SystemExit(f'WORKERS = {WORKERS} требует STORAGE_MODE = "sqlite", сейчас "{STORAGE_MODE}"')
+
+    config = {name: globals()[name] for name in _WORKER_CONFIG}
+    queues = [multiprocessing.Queue() for _ in range(WORKERS)]
+    workers = [multiprocessing.Process(target=worker_process, args=(i, queue, config), name=f"cities-worker-{i}")
+               for i, queue in enumerate(queues)]
+    for worker in workers:
+        worker.start()
+    try:
+        asyncio.run(_run_webhook_front(queues))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
 
 
 async def main() -> None:
-    bot = Bot(token=TOKEN)
-    await dp.start_polling(bot)
+    open_storages()
+    bot = make_bot()
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if RUN_MODE == "webhook":
+        run_webhook()
+    else:
+        asyncio.run(main())
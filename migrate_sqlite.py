@@ -0,0 +1,108 @@
+"""Перенос состояний игр и рекордов из файлов в общую базу SQLite (STORAGE_MODE = "sqlite").
+
+Читает снимки с журналами (bot_state.pkl + .log), файлы выгруженных игроков
+(bot_state.pkl.users) и highscores.json в обоих форматах - и свои, и файлы
+воркеров (bot_state.w0.pkl, highscores.w0.json, ...). Запускать при
+остановленном боте. Повторный запуск безопасен: более свежие игры в базе и
+более высокие рекорды не перезаписываются.
+
+Запуск: python migrate_sqlite.py [--db cities.db] [--state bot_state.pkl] [--highscores highscores.json]
+"""
+import argparse
+import glob
+import os
+import pickle
+import re
+import time
+from typing import Any, Dict, List, Tuple
+
+import main
+
+BATCH = 1000
+
+
+def with_worker_files(path: str) -> List[str]:
+    """Сам путь и пути воркеров (_worker_path), для которых есть хоть какой-то файл"""
+    root, ext = os.path.splitext(path)
+    worker = re.compile(re.escape(root) + r"\.w\d+" + re.escape(ext))
+    paths = {path}
+    for name in glob.glob(glob.escape(root) + ".w*"):
+        base = re.sub(r"\.(log|users)$", "", name)
+        if worker.fullmatch(base):
+            paths.add(base)
+    return sorted(p for p in paths if any(os.path.exists(p + suffix) for suffix in ("", ".log", ".users")))
+
+
+def read_sessions(path: str) -> Dict[int, Tuple[Any, Dict[str, Any], float]]:
+    """user_id -> (state, data, время последнего апдейта) из снимка, журнала и файлов игроков"""
+    sessions: Dict[int, Tuple[Any, Dict[str, Any], float]] = {}
+    # У записей без времени (режимы journal и pickle) берем время изменения файлов
+    file_time = max((os.path.getmtime(p) for p in (path, path + ".log") if os.path.exists(p)), default=time.time())
+
+    def add(user_id: int, entry: Dict[str, Any], updated: float):
+        if entry.get("state") is None and not entry.get("data"):
+            return  # пустые записи (например, "игрока нет на диске") не переносим
+        if user_id not in sessions or sessions[user_id][2] < updated:
+            sessions[user_id] = (entry.get("state"), entry.get("data") or {}, updated)
+
+    for user_id, entry in main.JournalFileStorage(path).data.items():
+        add(user_id, entry, entry.get("seen", file_time))
+
+    users_dir = path + ".users"
+    for root, _, files in os.walk(users_dir):
+        for name in files:
+            if not name.endswith(".pkl"):
+                continue
+            file_path = os.path.join(root, name)
+            try:
+                with open(file_path, "rb") as f:
+                    entry = pickle.load(f)
+            except Exception as e:
+                print(f"Пропущен {file_path}: {e}")
+                continue
+            add(int(name[:-4]), entry, entry.get("seen", os.path.getmtime(file_path)))
+    return sessions
+
+
+def migrate(db_path: str, state_path: str, highscores_path: str):
+    sessions: Dict[int, Tuple[Any, Dict[str, Any], float]] = {}
+    for path in with_worker_files(state_path):
+        found = read_sessions(path)
+        print(f"{path}: игр {len(found)}")
+        for user_id, session in found.items():
+            if user_id not in sessions or sessions[user_id][2] < session[2]:
+                sessions[user_id] = session
+
+    scores: Dict[str, int] = {}
+    names: Dict[str, str] = {}
+    for path in with_worker_files(highscores_path):
+        high_scores = main.HighScores(path)
+        print(f"{path}: рекордов {len(high_scores.scores)}")
+        for uid, score in high_scores.scores.items():
+            scores[uid] = max(score, scores.get(uid, 0))
+        names.update(high_scores.names)
+
+    storage = main.SqliteStorage(db_path)
+    rows = [(user_id, state, data, updated) for user_id, (state, data, updated) in sessions.items()]
+    for i in range(0, len(rows), BATCH):
+        storage.import_sessions(rows[i:i + BATCH])
+    storage.db.close()
+
+    db_scores = main.SqliteHighScores(db_path)
+    db_scores.import_scores(scores, names)
+    db_scores.db.close()
+    print(f"{db_path}: перенесено игр {len(rows)}, рекордов {len(scores)}; "
+          f"в базе рекордов {len(db_scores.scores)}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=main.SQLITE_PATH)
+    parser.add_argument("--state", default=main.STORAGE_PATH, help="снимок хранилища (файлы воркеров найдутся сами)")
+    parser.add_argument("--highscores", default=main.HIGHSCORES_FILE)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    migrate(args.db, args.state, args.highscores)